@@ -1,43 +1,192 @@
-import requests
+"""批量生成文本和语音
 
+从 JSONL 或 CSV 文件读取提示词，调用与网页端相同的配置和客户端生成回复并合成语音，
+音频写入输出目录，每条结果追加到 manifest.jsonl。中断后重新运行会跳过已成功的条目。
 
-def generate_completion(prompt, model="monika:latest"):
-    url = "http://localhost:11434/api/generate"
-    headers = {"Content-Type": "application/json"}
-    data = {"model": model, "prompt": prompt, "stream": False}
+输入格式：
+    JSONL：每行一个对象，{"id": "001", "prompt": "你好", "model": "qwen2.5:7b"}
+    CSV：  首行为表头，包含 id、prompt 列，可选 model 列
+    id 省略时使用行号；提供 text 字段时跳过文本生成，直接合成该文本；
+    voice 字段指定声音名称（见配置管理中的声音管理），省略时使用默认声音。
 
-    response = requests.post(url, headers=headers, json=data)
-    return response.json().get("response", "")
+用法示例：
+    python 0.py prompts.jsonl -o output --llm-workers 4 --tts-workers 2
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import aic_tts2 as app
 
-text = input("输入文本：")
-completion = generate_completion(text)
-print("LocalTalk：", completion)
 
-# 文本转语音服务的URL
-tts_url = "http://localhost:9880"
+def read_items(path):
+    """读取输入文件，返回 [{"id", "prompt", "model", "text"}]"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
 
+    items = []
+    for index, row in enumerate(rows, 1):
+        items.append({
+            "id": str(row.get("id") or index),
+            "prompt": row.get("prompt") or "",
+            "model": row.get("model") or None,
+            "text": row.get("text") or None,
+            "voice": row.get("voice") or None,
+        })
+    return items
 
-def test_tts_service(text):
-    tts_response = requests.get(
-        tts_url,
-        params={
-            "refer_wav_path": "参考音频",
-            "prompt_text": "参考文本",
-            "prompt_language": "zh",
-            "text": text,
-            "text_language": "zh",
-        },
-    )
 
-    if tts_response.status_code == 200:
-        with open("output_audio.wav", "wb") as f:
-            f.write(tts_response.content)
-        print("音频文件已成功保存为 output_audio.wav")
-    else:
-        print(f"Error in TTS service: {tts_response.text}")
+def read_finished(manifest_path):
+    """读取清单中已成功的条目 id"""
+    finished = set()
+    if not os.path.exists(manifest_path):
+        return finished
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中断时可能留下不完整的最后一行
+                continue
+            if record.get("status") == "ok":
+                finished.add(record["id"])
+    return finished
+
+
+def safe_filename(item_id):
+    return "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in item_id)
+
+
+class BatchRunner:
+    """文本生成和语音合成两级流水线，各自限制并发数"""
+
+    def __init__(self, output_dir, llm_workers, tts_workers, skip_tts=False):
+        self.output_dir = output_dir
+        self.skip_tts = skip_tts
+        self.llm_executor = ThreadPoolExecutor(max_workers=llm_workers, thread_name_prefix="llm")
+        self.tts_executor = ThreadPoolExecutor(max_workers=tts_workers, thread_name_prefix="tts")
+        self.manifest = open(os.path.join(output_dir, "manifest.jsonl"), "a", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.succeeded = 0
+        self.failed = 0
+
+    def submit(self, item):
+        self.llm_executor.submit(self._generate, item)
+
+    def _generate(self, item):
+        record = {"id": item["id"], "prompt": item["prompt"], "model": item["model"]}
+        try:
+            if item["voice"]:
+                record["voice"] = item["voice"]
+                if item["voice"] not in app.app_state.config.voices:
+                    raise ValueError(f"声音不存在: {item['voice']}")
+            if item["text"]:
+                record["text"] = item["text"]
+            else:
+                text, elapsed, model = app.generate_completion(item["prompt"], item["model"])
+                record.update(text=text.strip(), model=model, llm_seconds=round(elapsed, 3))
+        except Exception as e:
+            self._finish(record, error=e)
+            return
+
+        if self.skip_tts or not record["text"]:
+            self._finish(record)
+        else:
+            self.tts_executor.submit(self._synthesize, record)
+
+    def _synthesize(self, record):
+        filename = safe_filename(record["id"]) + ".wav"
+        path = os.path.join(self.output_dir, filename)
+        tmp_path = path + ".part"
+        start_time = time.time()
+        try:
+            # 先写临时文件，完整后再改名，中断时不会留下残缺的音频
+            voice = app.app_state.config.get_voice(record.get("voice"))
+            app.download_tts_audio(record["text"], tmp_path, voice=voice)
+            os.replace(tmp_path, path)
+            record.update(audio=filename, tts_seconds=round(time.time() - start_time, 3))
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._finish(record, error=e)
+            return
+        self._finish(record)
 
+    def _finish(self, record, error=None):
+        record["status"] = "error" if error else "ok"
+        if error:
+            record["error"] = str(error)
+        with self.lock:
+            self.manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.manifest.flush()
+            if error:
+                self.failed += 1
+            else:
+                self.succeeded += 1
+            status = f"失败: {error}" if error else "完成"
+            print(f"[{self.succeeded + self.failed}] {record['id']} {status}")
+
+    def wait(self):
+        """等待全部条目完成：文本生成全部结束后不会再有新的合成任务"""
+        self.llm_executor.shutdown()
+        self.tts_executor.shutdown()
+        self.manifest.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="批量生成LocalTalk的文本回复和语音")
+    parser.add_argument("input", help="输入文件（.jsonl 或 .csv）")
+    parser.add_argument("-o", "--output", default="batch_output", help="输出目录")
+    parser.add_argument("--config", default="config.ini", help="配置文件路径")
+    parser.add_argument("--llm-workers", type=int, default=2, help="文本生成并发数")
+    parser.add_argument("--tts-workers", type=int, default=None, help="语音合成并发数（默认取配置中的 tts_concurrency）")
+    parser.add_argument("--no-tts", action="store_true", help="只生成文本")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    app.app_state.config_file = args.config
+    if not app.app_state.load_config():
+        if os.path.exists(args.config):
+            sys.exit(f"配置文件 {args.config} 无效，请修改后重新运行")
+        sys.exit(f"配置文件不存在: {args.config}，请先运行 aic_tts2.py 完成配置")
+    missing = app.app_state.check_config()
+    if missing:
+        sys.exit(f"配置不完整，缺少: {', '.join(missing)}")
+
+    os.makedirs(args.output, exist_ok=True)
+    items = read_items(args.input)
+    finished = read_finished(os.path.join(args.output, "manifest.jsonl"))
+    todo = [item for item in items if item["id"] not in finished]
+    print(f"共 {len(items)} 条，已完成 {len(items) - len(todo)} 条，本次处理 {len(todo)} 条")
+
+    tts_workers = args.tts_workers or app.app_state.config.tts_concurrency
+    runner = BatchRunner(args.output, max(1, args.llm_workers), max(1, tts_workers), args.no_tts)
+    start_time = time.time()
+    try:
+        for item in todo:
+            runner.submit(item)
+        runner.wait()
+    except KeyboardInterrupt:
+        # 已写入清单的条目下次会被跳过
+        print("已中断，重新运行同样的命令即可继续")
+        os._exit(1)
+
+    print(
+        f"成功 {runner.succeeded} 条，失败 {runner.failed} 条，"
+        f"耗时 {time.time() - start_time:.1f}秒，清单: {os.path.join(args.output, 'manifest.jsonl')}"
+    )
 
-# 测试文本
 
-test_tts_service(completion)
+if __name__ == "__main__":
+    main()
@@ -1,286 +1,3498 @@
+import time
+# 开始导入本模块的时间，用于统计启动耗时
+STARTUP_BEGIN = time.time()
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import json
 import re
-import gradio as gr
-import time
 import os
-import sys
 import configparser
-from datetime import datetime
 import threading
+import atexit
+import asyncio
+import uuid
+import weakref
+import httpx
+import hashlib
+import importlib
+import unicodedata
+import io
+import wave
+from starlette.routing import Route
+from starlette.responses import PlainTextResponse
+from contextlib import nullcontext, contextmanager, asynccontextmanager, AsyncExitStack
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from types import MappingProxyType
+from concurrent.futures import Future
+
+
+class LazyModule:
+    """首次访问属性时才导入的模块"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# 导入Gradio需要数秒：网页端先启动后台任务再导入，批量生成等命令行工具只在出错时才用到
+gr = LazyModule("gradio")
+np = LazyModule("numpy")
+
+# ======================
+# 全局状态管理类
+# ======================
+def parse_bool(value):
+    text = str(value).strip().lower()
+    if text not in ("true", "false"):
+        raise ValueError("应为 True 或 False")
+    return text == "true"
+
+
+def parse_int(value):
+    try:
+        number = int(str(value).strip())
+    except ValueError:
+        raise ValueError("应为整数") from None
+    if number < 0:
+        raise ValueError("不能为负数")
+    return number
+
+
+def parse_float(value):
+    try:
+        number = float(str(value).strip())
+    except ValueError:
+        raise ValueError("应为数字") from None
+    if not number >= 0:
+        raise ValueError("不能为负数")
+    return number
+
+
+def parse_positive_float(value):
+    number = parse_float(value)
+    if number == 0:
+        raise ValueError("应为大于0的数")
+    return number
+
+
+def parse_list(value):
+    """逗号分隔的列表，忽略空项"""
+    return tuple(item.strip() for item in str(value).split(",") if item.strip())
+
+
+# Ollama 的时长格式，如 "30m"、"1h30m"、"90s"
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ns|us|µs|ms|s|m|h)")
+DURATION_UNITS = {"ns": 1e-9, "us": 1e-6, "µs": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_keep_alive(value):
+    """解析 keep_alive，返回 (发送给Ollama的值, 秒数)，秒数为 None 表示常驻内存
+
+    Ollama 接受以秒为单位的整数或 "30m" 这样的时长，负数表示常驻内存。
+    """
+    text = str(value).strip()
+    try:
+        seconds = int(text)
+    except ValueError:
+        body = text[1:] if text.startswith("-") else text
+        parts = DURATION_PART.findall(body)
+        if not body or "".join(number + unit for number, unit in parts) != body:
+            raise ValueError('应为秒数或 "30m" 这样的时长') from None
+        seconds = sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+        if text.startswith("-"):
+            seconds = -seconds
+        value = text
+    else:
+        value = seconds
+    return value, (None if seconds < 0 else seconds)
+
+
+def parse_model_keep_alive(value):
+    """解析按模型指定的 keep_alive，格式: 模型名=时长，多个模型用逗号分隔"""
+    result = {}
+    for item in parse_list(value):
+        name, separator, duration = item.partition("=")
+        if not separator or not name.strip():
+            raise ValueError('应为 "模型名=时长" 格式，多个模型用逗号分隔')
+        result[name.strip()] = parse_keep_alive(duration)
+    return result
+
+
+class VoiceProfile:
+    """声音配置：参考音频、参考文本及其语言，加上合成文本的语言"""
+
+    def __init__(self, name, reference_wav, prompt_text, prompt_language="zh", text_language="zh"):
+        self.name = name
+        self.reference_wav = reference_wav
+        self.prompt_text = prompt_text
+        self.prompt_language = prompt_language
+        self.text_language = text_language
+
+    @classmethod
+    def from_section(cls, name, section):
+        return cls(
+            name,
+            section.get("reference_wav", ""),
+            section.get("prompt_text", ""),
+            section.get("prompt_language", "zh"),
+            section.get("text_language", "zh"),
+        )
+
+    def to_section(self):
+        return {
+            "reference_wav": self.reference_wav,
+            "prompt_text": self.prompt_text,
+            "prompt_language": self.prompt_language,
+            "text_language": self.text_language,
+        }
+
+    @property
+    def reference_key(self):
+        """参考音频设置相同的声音共用服务端提取的参考特征"""
+        return (self.reference_wav, self.prompt_text, self.prompt_language)
+
+    def reference_params(self):
+        """GPT-SoVITS 请求中的参考音频参数"""
+        return {
+            "refer_wav_path": self.reference_wav,
+            "prompt_text": self.prompt_text,
+            "prompt_language": self.prompt_language,
+        }
+
+    def validate(self):
+        """检查声音配置，返回错误列表"""
+        errors = []
+        if not self.reference_wav.strip():
+            errors.append("参考音频路径不能为空")
+        elif not os.path.exists(self.reference_wav):
+            errors.append(f"参考音频文件不存在: {self.reference_wav}")
+        if not self.prompt_text.strip():
+            errors.append("参考文本不能为空")
+        return errors
+
+
+# TTS 节中的参考音频设置作为默认声音，其余声音保存在 [Voice:名称] 配置节中
+DEFAULT_VOICE = "默认"
+VOICE_SECTION_PREFIX = "Voice:"
+
+
+class ConfigSnapshot(Mapping):
+    """不可变的配置快照
+
+    按配置节读取（snapshot["API"].get(...)），各节为只读映射；数值和开关在创建时全部解析为同名属性，
+    任一项无效时抛出 ValueError，热路径直接读取属性。修改配置时整体替换为新快照，
+    正在进行的对话继续使用开始时的快照。
+    """
+
+    REQUIRED_FIELDS = [
+        ("API", "ollama_url", "Ollama API地址"),
+        ("API", "tts_url", "TTS服务地址"),
+        ("TTS", "reference_wav", "参考音频路径"),
+        ("TTS", "prompt_text", "参考文本"),
+    ]
+
+    # 按原文使用的配置项 (配置节, 键, 默认值)
+    TEXT_FIELDS = [
+        ("API", "ollama_url", ""),
+        ("API", "tts_url", ""),
+        ("TTS", "reference_wav", ""),
+        ("TTS", "prompt_text", ""),
+        ("TTS", "prompt_language", "zh"),
+        ("TTS", "text_language", "zh"),
+        ("TTS", "voice", ""),
+    ]
+
+    # (配置节, 键, 解析函数, 默认值)，解析结果保存为与键同名的属性
+    PARSED_FIELDS = [
+        ("API", "default_model", str, "qwen2.5vl:latest"),
+        ("API", "enable_stream", parse_bool, "True"),
+        ("TTS", "enable_tts", parse_bool, "True"),
+        ("TTS", "pipeline_tts", parse_bool, "True"),
+        ("TTS", "tts_concurrency", parse_int, "2"),
+        # 边下载边播放；GPT-SoVITS 的 api.py 需以 -sm normal 启动才会分块返回音频，请求本身不带流式参数
+        ("TTS", "tts_streaming", parse_bool, "False"),
+        ("Chat", "enable_history", parse_bool, "True"),
+        ("Chat", "history_max_tokens", parse_int, "2048"),
+        ("Chat", "history_summary", parse_bool, "True"),
+        ("Performance", "concurrency_limit", parse_int, "16"),
+        ("Performance", "async_backend", parse_bool, "True"),
+        ("Performance", "ollama_pool_size", parse_int, "8"),
+        ("Performance", "tts_pool_size", parse_int, "8"),
+        ("Performance", "connect_timeout", parse_float, "5"),
+        ("Performance", "ollama_read_timeout", parse_float, "30"),
+        ("Performance", "tts_read_timeout", parse_float, "300"),
+        ("Performance", "http_retries", parse_int, "2"),
+        ("Performance", "tts_cache", parse_bool, "True"),
+        ("Performance", "tts_cache_dir", str, "tts_cache"),
+        ("Performance", "tts_cache_max_mb", parse_float, "512"),
+        ("Performance", "response_cache", parse_bool, "False"),
+        ("Performance", "response_cache_file", str, "response_cache.json"),
+        ("Performance", "response_cache_ttl", parse_float, "86400"),
+        ("Performance", "response_cache_size", parse_int, "500"),
+        ("Performance", "response_cache_exclude", parse_list, ""),
+        ("Performance", "audio_dir", str, "audio_output"),
+        ("Performance", "audio_max_age_minutes", parse_float, "60"),
+        ("Performance", "audio_max_mb", parse_float, "512"),
+        ("Performance", "audio_in_memory", parse_bool, "False"),
+        ("Performance", "render_fps", parse_float, "25"),
+        ("Performance", "render_chars_per_second", parse_float, "60"),
+        ("Performance", "render_max_seconds", parse_float, "3"),
+        ("Performance", "warmup_models", parse_bool, "True"),
+        ("Performance", "keep_alive", parse_keep_alive, "30m"),
+        ("Performance", "model_keep_alive", parse_model_keep_alive, ""),
+        ("Performance", "model_load_timeout", parse_float, "300"),
+        ("Performance", "model_list_ttl", parse_float, "300"),
+        ("Performance", "config_watch_interval", parse_float, "2"),
+        ("Performance", "llm_concurrency", parse_int, "4"),
+        ("Performance", "llm_queue_size", parse_int, "32"),
+        ("Performance", "tts_queue_size", parse_int, "64"),
+        ("Performance", "health_check_interval", parse_float, "15"),
+        ("Performance", "breaker_failures", parse_int, "3"),
+        ("Performance", "breaker_probe_interval", parse_positive_float, "10"),
+        ("Performance", "enable_metrics", parse_bool, "True"),
+    ]
+
+    def __init__(self, sections, version=0):
+        self._sections = {
+            name: MappingProxyType(dict(values)) for name, values in sections.items()
+        }
+        self.version = version
+
+        missing = []
+        for section, key, name in self.REQUIRED_FIELDS:
+            if not self.get(section, {}).get(key, "").strip():
+                missing.append(f"{name} ({section}.{key})")
+        self.missing = tuple(missing)
+
+        errors = []
+        for section, key, parse, default in self.PARSED_FIELDS:
+            value = self.get(section, {}).get(key, default)
+            try:
+                setattr(self, key, parse(value))
+            except ValueError as e:
+                errors.append(f"{section}.{key} = {value}（{e}）")
+        if errors:
+            raise ValueError(f"配置无效: {'；'.join(errors)}")
+
+        api = self.get("API", {})
+        tts = self.get("TTS", {})
+        self.endpoint_urls = {
+            "ollama": parse_list(api.get("ollama_url", "")),
+            "tts": parse_list(api.get("tts_url", "")),
+        }
+
+        self.voices = {DEFAULT_VOICE: VoiceProfile.from_section(DEFAULT_VOICE, tts)}
+        for section, values in self._sections.items():
+            if section.startswith(VOICE_SECTION_PREFIX):
+                name = section[len(VOICE_SECTION_PREFIX):]
+                self.voices[name] = VoiceProfile.from_section(name, values)
+        voice = tts.get("voice", "")
+        self.default_voice = voice if voice in self.voices else DEFAULT_VOICE
+
+    @classmethod
+    def fields(cls):
+        """所有已知配置项的 (配置节, 键, 默认值)"""
+        return cls.TEXT_FIELDS + [(section, key, default) for section, key, _, default in cls.PARSED_FIELDS]
+
+    def get_voice(self, name=None):
+        """按名称返回声音配置，名称为空或不存在时返回默认声音"""
+        return self.voices.get(name) or self.voices[self.default_voice]
+
+    def get_keep_alive(self, model):
+        """返回模型的 (keep_alive, 秒数)，model_keep_alive 中可按模型单独指定"""
+        return self.model_keep_alive.get(model, self.keep_alive)
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __iter__(self):
+        return iter(self._sections)
+
+    def __len__(self):
+        return len(self._sections)
+
+
+class AppState:
+    """保存当前配置快照，配置保存或文件在磁盘上变化时原子替换并通知监听者"""
+
+    def __init__(self):
+        self.config_file = "config.ini"
+        self.first_run = not os.path.exists(self.config_file)
+        self.config = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._watcher = None
+
+    def load_config(self):
+        """加载配置文件，返回新的配置快照；文件不存在或配置无效时返回 None"""
+        if not os.path.exists(self.config_file):
+            return None
+
+        # 读取前记下修改时间：读取期间文件再被修改时，监视线程会再加载一次
+        mtime = self._file_mtime()
+        config = configparser.ConfigParser()
+        config.read(self.config_file)
+
+        # 配置项和默认值以 ConfigSnapshot 中的定义为准
+        sections = {}
+        for section, key, default in ConfigSnapshot.fields():
+            sections.setdefault(section, {})[key] = config.get(section, key, fallback=default)
+        for section in config.sections():
+            if section.startswith(VOICE_SECTION_PREFIX):
+                sections[section] = dict(config[section])
+        if not self._apply(sections, mtime):
+            return None
+        return self.config
+
+    def save_config(self, config_data):
+        """保存配置文件，config_data 中值为 None 的配置节会被删除"""
+        # 合并当前配置，保留界面上未涉及的配置项
+        if self.config:
+            merged = {section: dict(values) for section, values in self.config.items()}
+            for section, values in config_data.items():
+                if values is None:
+                    merged.pop(section, None)
+                else:
+                    merged.setdefault(section, {}).update(values)
+            config_data = merged
+
+        # 配置无效时不写入文件，继续使用当前配置
+        try:
+            ConfigSnapshot(config_data)
+        except ValueError as e:
+            print(f"配置未保存，{str(e)}")
+            return False
+
+        config = configparser.ConfigParser()
+        for section, values in config_data.items():
+            config[section] = values
+
+        # 写入临时文件后替换，监视线程不会读到写了一半的文件
+        tmp_path = f"{self.config_file}.tmp"
+        with open(tmp_path, "w") as f:
+            config.write(f)
+        os.replace(tmp_path, self.config_file)
+
+        # 从文件重新加载，新快照包含所有默认值
+        return self.load_config() is not None
+
+    def check_config(self):
+        """检查必要配置是否完整"""
+        if not self.config:
+            return ["配置文件未加载"]
+        return list(self.config.missing)
+
+    def add_listener(self, listener):
+        """注册配置变化回调 listener(旧快照, 新快照)"""
+        self._listeners.append(listener)
+
+    def _apply(self, sections, mtime=None):
+        """原子替换配置快照并通知监听者，返回是否已替换；配置无效时保留当前快照
+
+        mtime 为读取配置文件前记下的修改时间，省略时使用文件当前的修改时间。
+        """
+        with self._lock:
+            old = self.config
+            # 无效的配置文件也记下修改时间，文件再次修改后才重新加载
+            self._mtime = self._file_mtime() if mtime is None else mtime
+            try:
+                new = ConfigSnapshot(sections, version=old.version + 1 if old else 1)
+            except ValueError as e:
+                print(f"{str(e)}，继续使用当前配置" if old else str(e))
+                return False
+            self.config = new
+        self.first_run = False
+        for listener in self._listeners:
+            try:
+                listener(old, new)
+            except Exception as e:
+                print(f"应用配置变化失败: {str(e)}")
+        return True
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def watch(self, interval=2):
+        """启动后台线程，配置文件在磁盘上被修改后自动重新加载"""
+        if self._watcher is None and interval > 0:
+            self._watcher = threading.Thread(
+                target=self._watch_loop, args=(interval,), name="config-watch", daemon=True
+            )
+            self._watcher.start()
+
+    def _watch_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            mtime = self._file_mtime()
+            if mtime is not None and mtime != self._mtime:
+                print("检测到配置文件变化，重新加载配置")
+                try:
+                    self.load_config()
+                except Exception as e:
+                    # 文件可能正在写入，下一轮再试
+                    print(f"重新加载配置失败: {str(e)}")
+
+
+# ======================
+# 会话状态管理类
+# ======================
+class TurnCancelled(Exception):
+    """本轮对话已被停止或被新消息打断"""
+
+    def __init__(self, message="本轮对话已取消"):
+        super().__init__(message)
+
+
+class CancelToken:
+    """一轮对话的取消标记
+
+    进行中的操作用 watch() 登记中断方法（关闭HTTP响应、放弃排队名额等），
+    cancel() 可从任意线程调用，立即执行所有已登记的中断方法。
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        """已取消时抛出 TurnCancelled"""
+        if self.event.is_set():
+            raise TurnCancelled()
+
+    def cancel(self):
+        with self._lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消操作时出错: {str(e)}")
+
+    @contextmanager
+    def watch(self, callback):
+        """在 with 块执行期间登记中断方法，已取消时立即调用并抛出 TurnCancelled"""
+        with self._lock:
+            cancelled = self.event.is_set()
+            if not cancelled:
+                self._callbacks.append(callback)
+        if cancelled:
+            callback()
+            raise TurnCancelled()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if callback in self._callbacks:
+                    self._callbacks.remove(callback)
+
+    async def wait_for(self, awaitable):
+        """在单独的任务中等待 awaitable，取消时立即取消该任务并抛出 TurnCancelled"""
+        task = asyncio.ensure_future(awaitable)
+        loop = task.get_loop()
+        try:
+            with self.watch(lambda: loop.call_soon_threadsafe(task.cancel)):
+                return await task
+        except asyncio.CancelledError:
+            self.check()
+            raise
+        finally:
+            task.cancel()
+
+    async def aiter(self, iterator):
+        """在单独的任务中读取异步迭代器并逐项产出
+
+        取消时直接取消该任务，迭代器中正在等待的HTTP请求随之中断，无论是否已收到响应头。
+        """
+        items = asyncio.Queue()
+        end = object()
+
+        async def produce():
+            try:
+                async for item in iterator:
+                    items.put_nowait((item, None))
+                items.put_nowait((end, None))
+            except BaseException as e:
+                items.put_nowait((end, e))
+
+        task = asyncio.ensure_future(produce())
+        loop = task.get_loop()
+        try:
+            with self.watch(lambda: loop.call_soon_threadsafe(task.cancel)):
+                while True:
+                    item, error = await items.get()
+                    if item is not end:
+                        yield item
+                        continue
+                    self.check()
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            task.cancel()
+
+
+class TurnState:
+    """单轮对话的音频相关状态，每次发送消息时新建"""
+    def __init__(self):
+        # 本轮对话使用开始时的配置快照，对话中途保存配置不影响本轮
+        self.config = app_state.config
+        self.cancel_token = CancelToken()
+        self.start_time = time.time()
+        self.audio_generated = threading.Event()
+        self.audio_file_path = None
+        self.tts_error = None
+        self.tts_elapsed = None
+        self.audio_started = False
+        self.text_only = False  # 语音服务熔断，本轮只回复文字
+        self.tts_pipeline = None
+        self.tts_task = None
+        self.conversation = None
+        self.session_id = None
+        self.voice = None
+        self.llm_ticket = None
+        self.tts_ticket = None  # 整段合成时的语音排队名额
+        self._audio_waiters = []
+        self._lock = threading.Lock()
+
+    def mark_audio_done(self):
+        """标记语音生成结束，并唤醒所有等待者（可从任意线程调用）"""
+        self.audio_generated.set()
+        with self._lock:
+            waiters, self._audio_waiters = self._audio_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_resolve_waiter, waiter)
+
+    async def wait_audio(self, timeout=None):
+        """在事件循环中等待语音生成结束，不占用线程；超时返回 False"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.audio_generated.is_set():
+                return True
+            waiter = loop.create_future()
+            self._audio_waiters.append((loop, waiter))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if (loop, waiter) in self._audio_waiters:
+                    self._audio_waiters.remove((loop, waiter))
+            return self.audio_generated.is_set()
+        return True
+
+    def cancel(self):
+        """停止本轮对话：中断文本生成和语音合成的HTTP请求，放弃排队中的名额（可从任意线程调用）"""
+        if self.cancel_token.cancelled:
+            return
+        self.cancel_token.cancel()
+        if self.llm_ticket:
+            self.llm_ticket.release()
+        if self.tts_pipeline:
+            self.tts_pipeline.cancel()
+        if self.tts_task:
+            self.tts_task.get_loop().call_soon_threadsafe(self.tts_task.cancel)
+        if not self.audio_generated.is_set():
+            self.tts_error = self.tts_error or "已取消"
+            self.mark_audio_done()
+
+    def pipeline_finished(self, pipeline):
+        """流水线完成后更新语音状态"""
+        self.tts_elapsed = f"{pipeline.elapsed:.2f}秒"
+        if pipeline.first_audio_elapsed is not None:
+            self.tts_elapsed += f"（首段 {pipeline.first_audio_elapsed:.2f}秒）"
+            first_audio_at = pipeline.start_time + pipeline.first_audio_elapsed
+            METRIC_FIRST_AUDIO.observe(first_audio_at - self.start_time)
+        if pipeline.errors:
+            self.tts_error = pipeline.errors[0]
+        self.mark_audio_done()
+
+
+def _resolve_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def estimate_tokens(text):
+    """粗略估算令牌数：中日韩字符按每字一个令牌，其余按每4个字符一个令牌"""
+    cjk = sum(1 for ch in text if "\u3000" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class Conversation:
+    """多轮对话历史，按 /api/chat 的消息格式保存
+
+    历史只在末尾追加，Ollama 可以复用上一轮已计算的前缀，每轮只需预填充新增的消息。
+    超出令牌预算时一次丢弃最早的若干轮，直到历史降到预算的一半以下，
+    这样前缀失效的情况很少发生；被丢弃的内容在后台总结为摘要放在历史开头。
+    """
+
+    # 每条消息的模板开销（角色标记等）
+    MESSAGE_OVERHEAD = 4
+
+    def __init__(self, max_tokens=2048, summarize=True):
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        self.summary = ""
+        self.exchanges = []  # [(用户消息, 回复, 令牌数)]
+        self._lock = threading.Lock()
+        self._summary_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        """按配置创建对话历史，未启用多轮对话时返回 None"""
+        config = app_state.config
+        if not config or not config.enable_history:
+            return None
+        return cls(max_tokens=config.history_max_tokens, summarize=config.history_summary)
+
+    def history(self):
+        """返回发送给 /api/chat 的历史消息（不含本轮的用户消息）"""
+        with self._lock:
+            messages = []
+            if self.summary:
+                messages.append({"role": "system", "content": f"之前对话的摘要：{self.summary}"})
+            for user_text, reply_text, _ in self.exchanges:
+                messages.append({"role": "user", "content": user_text})
+                messages.append({"role": "assistant", "content": reply_text})
+            return messages
+
+    def add_exchange(self, user_text, reply_text, model=None, reply_tokens=None):
+        """记录一轮对话，超出预算时截断并在后台生成摘要"""
+        tokens = (
+            estimate_tokens(user_text)
+            + (reply_tokens or estimate_tokens(reply_text))
+            + 2 * self.MESSAGE_OVERHEAD
+        )
+        with self._lock:
+            self.exchanges.append((user_text, reply_text, tokens))
+            dropped = self._truncate()
+        if dropped and self.summarize:
+            threading.Thread(
+                target=self._summarize, args=(dropped, model), daemon=True
+            ).start()
+
+    def clear(self):
+        """清空对话历史"""
+        with self._lock:
+            self.summary = ""
+            self.exchanges = []
+
+    def _total_tokens(self):
+        total = sum(tokens for _, _, tokens in self.exchanges)
+        if self.summary:
+            total += estimate_tokens(self.summary) + self.MESSAGE_OVERHEAD
+        return total
+
+    def _truncate(self):
+        """超出预算时丢弃最早的对话，返回被丢弃的部分"""
+        if self._total_tokens() <= self.max_tokens:
+            return []
+        dropped = []
+        while self.exchanges and self._total_tokens() > self.max_tokens // 2:
+            dropped.append(self.exchanges.pop(0))
+        return dropped
+
+    def _summarize(self, dropped, model):
+        """把旧摘要和被丢弃的对话总结为新摘要"""
+        with self._summary_lock:
+            lines = [f"之前的摘要：{self.summary}"] if self.summary else []
+            for user_text, reply_text, _ in dropped:
+                lines.append(f"用户：{user_text}")
+                lines.append(f"助手：{reply_text}")
+            prompt = "请用不超过200字概括下面这段对话的要点，供后续对话参考：\n" + "\n".join(lines)
+            # 与对话共用文本生成的并发名额，排在用户请求之后
+            ticket = get_scheduler("llm").enqueue(None, background=True)
+            try:
+                ticket.wait()
+                summary, _, _ = generate_completion(prompt, model, task="summary")
+            except Exception as e:
+                print(f"生成对话摘要失败: {str(e)}")
+                return
+            finally:
+                ticket.release()
+            with self._lock:
+                self.summary = summary.strip()
+
+
+class SessionState:
+    """会话状态，保存在 gr.State 中，每个浏览器会话各自一份"""
+    def __init__(self):
+        self.session_id = uuid.uuid4().hex
+        self.turn = None
+        self.conversation = Conversation.from_config()
+        self.voice = None  # 本会话选择的声音，None 表示使用默认声音
+
+    def new_turn(self):
+        """开始新一轮对话，返回新的请求状态；上一轮尚未结束时将其停止"""
+        # 先替换再停止，被打断的一轮据此判断无需再输出
+        previous, turn = self.turn, TurnState()
+        turn.session_id = self.session_id
+        turn.conversation = self.conversation
+        if turn.config:
+            turn.voice = turn.config.get_voice(self.voice)
+        self.turn = turn
+        if previous:
+            previous.cancel()
+        return turn
+
+
+# 初始化应用状态；配置由 launch_application 或调用方加载，导入本模块时不读取配置文件
+app_state = AppState()
+
+# ======================
+# 性能指标
+# ======================
+# 各阶段耗时以直方图累计，通过 /metrics 以 Prometheus 文本格式导出。
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+class Counter:
+    """计数器，按标签分别计数"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    """直方图，按标签分别累计各区间的计数、总和与次数"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # 标签 -> [各区间计数, 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(key + (("le", repr(float(bound))),))
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60, 120)
+
+METRIC_LLM_TTFT = Histogram(
+    "localtalk_llm_time_to_first_token_seconds", "文本生成首字延迟", LATENCY_BUCKETS
+)
+METRIC_LLM_DURATION = Histogram(
+    "localtalk_llm_generation_seconds", "文本生成总耗时", LATENCY_BUCKETS
+)
+METRIC_LLM_TOKEN_RATE = Histogram(
+    "localtalk_llm_tokens_per_second", "文本生成速度（令牌/秒）",
+    (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300),
+)
+METRIC_LLM_BACKGROUND = Histogram(
+    "localtalk_llm_background_seconds", "后台文本生成（task=summary 为对话摘要）耗时，不含排队", LATENCY_BUCKETS
+)
+METRIC_TTS_DURATION = Histogram(
+    "localtalk_tts_synthesis_seconds", "单次语音合成请求耗时（不含缓存命中）", LATENCY_BUCKETS
+)
+METRIC_TTS_RTF = Histogram(
+    "localtalk_tts_real_time_factor", "语音合成实时率（合成耗时/音频时长）",
+    (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5),
+)
+METRIC_QUEUE_WAIT = Histogram(
+    "localtalk_queue_wait_seconds", "请求排队等待时间", LATENCY_BUCKETS
+)
+METRIC_QUEUE_REJECTED = Counter(
+    "localtalk_queue_rejected_total", "因队列已满被拒绝的请求数"
+)
+METRIC_FIRST_AUDIO = Histogram(
+    "localtalk_time_to_first_audio_seconds", "从发送消息到首段语音就绪的时间", LATENCY_BUCKETS
+)
+METRIC_TURN_DURATION = Histogram(
+    "localtalk_turn_seconds", "一轮对话端到端耗时（文本与语音均完成）", LATENCY_BUCKETS
+)
+METRIC_CIRCUIT_OPEN = Counter(
+    "localtalk_circuit_open_total", "节点因连续失败被暂停使用（熔断）的次数"
+)
+METRIC_RESPONSE_CACHE = Counter(
+    "localtalk_response_cache_requests_total", "文本回复缓存查询次数（result=hit/miss）"
+)
+
+METRICS = [
+    METRIC_LLM_TTFT,
+    METRIC_LLM_DURATION,
+    METRIC_LLM_TOKEN_RATE,
+    METRIC_LLM_BACKGROUND,
+    METRIC_TTS_DURATION,
+    METRIC_TTS_RTF,
+    METRIC_QUEUE_WAIT,
+    METRIC_QUEUE_REJECTED,
+    METRIC_FIRST_AUDIO,
+    METRIC_TURN_DURATION,
+    METRIC_RESPONSE_CACHE,
+    METRIC_CIRCUIT_OPEN,
+]
+
+def render_metrics():
+    """以Prometheus文本格式导出所有指标"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+async def metrics_endpoint(request):
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def record_completion_metrics(model, elapsed, first_token_elapsed, stats):
+    """记录一次文本生成的指标，stats 为Ollama最后一条返回（含 eval_count 等统计）"""
+    METRIC_LLM_DURATION.observe(elapsed, model=model)
+    if first_token_elapsed is not None:
+        METRIC_LLM_TTFT.observe(first_token_elapsed, model=model)
+    tokens, duration = stats.get("eval_count"), stats.get("eval_duration")
+    if tokens and duration:
+        # eval_duration 单位为纳秒
+        METRIC_LLM_TOKEN_RATE.observe(tokens / (duration / 1e9), model=model)
+
+def wav_duration(header, total_bytes):
+    """由WAV文件头和总字节数计算音频时长（秒），无法识别时返回 None"""
+    if len(header) < 44 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+    channels = int.from_bytes(header[22:24], "little")
+    sample_rate = int.from_bytes(header[24:28], "little")
+    bits = int.from_bytes(header[34:36], "little")
+    bytes_per_second = sample_rate * channels * bits // 8
+    if not bytes_per_second:
+        return None
+    return (total_bytes - 44) / bytes_per_second
+
+def record_tts_metrics(elapsed, header, total_bytes):
+    """记录一次语音合成请求的耗时和实时率"""
+    METRIC_TTS_DURATION.observe(elapsed)
+    duration = wav_duration(header, total_bytes)
+    if duration:
+        METRIC_TTS_RTF.observe(elapsed / duration)
+
+# ======================
+# HTTP 客户端
+# ======================
+class BackendClient:
+    """单个后端的HTTP客户端：连接池复用、keep-alive、重试及分离的连接/读取超时
+
+    用于健康检查、模型预热和声音登记等后台请求；对话中的请求使用异步客户端，可随时取消。
+    """
+
+    def __init__(self, pool_size=8, connect_timeout=5, read_timeout=30, retries=2):
+        self.timeout = (connect_timeout, read_timeout)
+        # 连接失败总是可以安全重试；网关错误只对幂等的GET重试
+        retry = Retry(
+            total=None,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            backoff_factor=0.2,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+_http_clients = {}
+_async_http_clients = weakref.WeakKeyDictionary()  # 事件循环 -> {后端: 异步客户端}
+_http_clients_lock = threading.Lock()
+
+def get_backend_settings(backend):
+    """读取指定后端（"ollama" 或 "tts"）的连接池与超时配置"""
+    config = app_state.config or ConfigSnapshot({})
+    return {
+        "pool_size": getattr(config, f"{backend}_pool_size"),
+        "connect_timeout": config.connect_timeout,
+        "read_timeout": getattr(config, f"{backend}_read_timeout"),
+        "retries": config.http_retries,
+    }
+
+def get_http_client(backend):
+    """获取指定后端共享的HTTP客户端"""
+    with _http_clients_lock:
+        client = _http_clients.get(backend)
+        if client is None:
+            client = BackendClient(**get_backend_settings(backend))
+            _http_clients[backend] = client
+        return client
+
+def get_async_http_client(backend):
+    """获取当前事件循环上指定后端共享的异步HTTP客户端"""
+    loop = asyncio.get_running_loop()
+    with _http_clients_lock:
+        clients = _async_http_clients.setdefault(loop, {})
+        client = clients.get(backend)
+        if client is None:
+            settings = get_backend_settings(backend)
+            limits = httpx.Limits(
+                max_connections=settings["pool_size"],
+                max_keepalive_connections=settings["pool_size"],
+            )
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    settings["read_timeout"], connect=settings["connect_timeout"]
+                ),
+                # 异步传输层只重试连接失败
+                transport=httpx.AsyncHTTPTransport(
+                    limits=limits, retries=settings["retries"]
+                ),
+            )
+            clients[backend] = client
+        return client
+
+def reset_http_clients():
+    """关闭现有客户端，下次请求时按最新配置重建"""
+    with _http_clients_lock:
+        for client in _http_clients.values():
+            client.close()
+        _http_clients.clear()
+        # 异步客户端属于各自的事件循环，提交到所在的事件循环上关闭；已停止的事件循环无法关闭，只丢弃引用
+        for loop, clients in list(_async_http_clients.items()):
+            if loop.is_running():
+                for client in clients.values():
+                    asyncio.run_coroutine_threadsafe(client.aclose(), loop)
+        _async_http_clients.clear()
+
+# ======================
+# 同步接口
+# ======================
+# 文本生成、语音合成和聊天流程只有异步实现。同步接口（批量脚本、关闭异步后端时的界面）
+# 把协程提交到后台线程中共享的事件循环执行，调用线程等待结果。
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+def get_background_loop():
+    """获取在后台线程中运行的共享事件循环"""
+    global _background_loop
+    with _background_loop_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_background_loop.run_forever, name="async-backend", daemon=True
+            ).start()
+        return _background_loop
+
+def _submit_to_background(coroutine):
+    loop = get_background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coroutine.close()
+        raise RuntimeError("不能在后台事件循环中调用同步接口")
+    return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+def run_sync(coroutine, cancel=None):
+    """在后台事件循环中执行协程并等待结果，cancel 被取消时中断协程并抛出 TurnCancelled"""
+    if cancel:
+        coroutine = cancel.wait_for(coroutine)
+    return _submit_to_background(coroutine).result()
+
+def iterate_sync(iterator):
+    """在后台事件循环中读取异步生成器，逐项同步产出；提前结束时关闭生成器"""
+    async def next_item():
+        return await iterator.__anext__()
+
+    try:
+        while True:
+            try:
+                item = _submit_to_background(next_item()).result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        _submit_to_background(iterator.aclose()).result()
+
+# ======================
+# 后端节点
+# ======================
+# ollama_url 和 tts_url 可以用逗号分隔填写多个节点，请求按未完成请求数最少的节点路由，
+# 节点不可用时自动换下一个节点。
+class BackendUnavailable(RuntimeError):
+    """后端所有节点都已熔断，请求直接失败而不等待超时"""
+
+
+class Endpoint:
+    """一个后端节点的状态"""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        self.models = None  # 节点上已安装的模型（仅Ollama），None 表示未知
+        self.last_error = None
+        self.failures = 0  # 连续失败次数
+        self.circuit_open = False  # 熔断：连续失败达到上限后不再发送请求，恢复前由后台检测
+        self.probing = False
+        self.latency = None  # 响应延迟的滑动平均（秒）
+
+
+class EndpointPool:
+    """同一后端的多个节点：健康检查、最少未完成请求路由、故障转移和熔断
+
+    节点连续失败（连接失败、5xx 或超时）达到 failure_threshold 次后熔断，不再参与请求，
+    由健康检查线程（每 check_interval 秒）或没有健康检查时的探测线程（每 probe_interval 秒）
+    检查，恢复后重新启用；所有节点都熔断时请求立即失败。
+    """
+
+    # 响应延迟滑动平均中新样本的权重
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(self, backend, urls, check_interval=15, failure_threshold=3, probe_interval=10):
+        self.backend = backend
+        self.urls = tuple(urls)
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.check_interval = check_interval
+        self.failure_threshold = max(1, failure_threshold)
+        self.probe_interval = probe_interval
+        self.settings = (check_interval, failure_threshold, probe_interval)
+        self.lock = threading.Lock()
+        self._rotation = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def candidates(self, model=None):
+        """按尝试顺序返回节点
+
+        优先选择健康、未完成请求最少的节点，不健康的节点排在最后作为兜底；
+        熔断的节点和已知没有该模型的节点不参与（所有节点都没有该模型时仍全部尝试）。
+        """
+        if not self.endpoints:
+            return []
+        with self.lock:
+            # 轮换起点，未完成请求数相同的节点轮流使用
+            self._rotation = (self._rotation + 1) % len(self.endpoints)
+            endpoints = self.endpoints[self._rotation:] + self.endpoints[:self._rotation]
+            endpoints = [endpoint for endpoint in endpoints if not endpoint.circuit_open]
+            if model:
+                endpoints = [
+                    endpoint for endpoint in endpoints
+                    if endpoint.models is None or model in endpoint.models
+                ] or endpoints
+            return sorted(endpoints, key=lambda endpoint: (not endpoint.healthy, endpoint.outstanding))
+
+    @contextmanager
+    def track(self, endpoint):
+        """统计节点上未完成的请求数"""
+        with self.lock:
+            endpoint.outstanding += 1
+        try:
+            yield endpoint
+        finally:
+            with self.lock:
+                endpoint.outstanding -= 1
+
+    def available(self):
+        """是否还有未熔断的节点"""
+        with self.lock:
+            return any(not endpoint.circuit_open for endpoint in self.endpoints)
+
+    def unavailable_error(self):
+        """没有可用节点时抛出的错误"""
+        with self.lock:
+            errors = [endpoint.last_error for endpoint in self.endpoints if endpoint.last_error]
+        if not errors:
+            return RuntimeError(f"{self.backend} 没有可用的节点")
+        return BackendUnavailable(
+            f"{self.backend} 服务暂不可用，每 {self.recovery_interval():g}秒自动检测恢复: {errors[0]}"
+        )
+
+    def recovery_interval(self):
+        """熔断的节点多久检测一次：有健康检查线程时由它负责，否则由探测线程负责"""
+        return self.check_interval if self._thread is not None else self.probe_interval
+
+    def mark_ok(self, endpoint, elapsed=None):
+        """请求成功：关闭熔断，elapsed 为收到响应所用的时间"""
+        with self.lock:
+            endpoint.healthy = True
+            endpoint.last_error = None
+            endpoint.failures = 0
+            if endpoint.circuit_open:
+                endpoint.circuit_open = False
+                print(f"{self.backend} 节点 {endpoint.url} 已恢复")
+            if elapsed is not None:
+                if endpoint.latency is None:
+                    endpoint.latency = elapsed
+                else:
+                    endpoint.latency += self.LATENCY_WEIGHT * (elapsed - endpoint.latency)
+
+    def _record_failure(self, endpoint, error):
+        """记录一次失败，连续失败达到上限时熔断并在后台检测恢复（调用方需持有锁）"""
+        endpoint.healthy = False
+        endpoint.last_error = str(error) or type(error).__name__
+        endpoint.failures += 1
+        if endpoint.circuit_open or endpoint.failures < self.failure_threshold:
+            return
+        endpoint.circuit_open = True
+        METRIC_CIRCUIT_OPEN.inc(backend=self.backend)
+        print(f"{self.backend} 节点 {endpoint.url} 连续失败 {endpoint.failures} 次，暂停使用")
+        # 多个节点时由健康检查线程负责恢复
+        if self._thread is None and not endpoint.probing:
+            endpoint.probing = True
+            threading.Thread(
+                target=self._probe_loop, args=(endpoint,), name=f"{self.backend}-probe", daemon=True
+            ).start()
+
+    def _probe_loop(self, endpoint):
+        """熔断期间定期检查节点，恢复后结束"""
+        try:
+            while not self._stop.wait(self.probe_interval):
+                if self.check(endpoint):
+                    return
+        finally:
+            with self.lock:
+                endpoint.probing = False
+
+    def handle_failure(self, endpoint, error, model=None):
+        """判断请求失败后是否应换节点重试，节点不可用时标记为不健康并计入熔断"""
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+        connect_errors = (requests.ConnectionError, httpx.ConnectError, httpx.ConnectTimeout)
+        timeout_errors = (requests.Timeout, httpx.TimeoutException)
+        with self.lock:
+            if isinstance(error, connect_errors) or (status is not None and status >= 500):
+                self._record_failure(endpoint, error)
+                print(f"{self.backend} 节点 {endpoint.url} 不可用: {str(error)}")
+                if self.backend == "tts":
+                    # 服务可能已重启，登记的默认声音需要重新登记
+                    get_voice_registry().forget(endpoint.url)
+                return True
+            if isinstance(error, timeout_errors):
+                # 节点可能卡住：请求可能已在执行，不换节点重试，但计入熔断
+                self._record_failure(endpoint, error)
+                return False
+            # Ollama 节点上没有该模型
+            if status == 404 and model and self.backend == "ollama":
+                if endpoint.models is not None:
+                    endpoint.models.discard(model)
+                return True
+        return False
+
+    def check(self, endpoint):
+        """检查单个节点，Ollama节点同时更新已安装的模型"""
+        client = get_http_client(self.backend)
+        timeout = (client.timeout[0], 5)
+        try:
+            if self.backend == "ollama":
+                response = client.get(get_ollama_api_url(endpoint.url, "tags"), timeout=timeout)
+                response.raise_for_status()
+                models = {model["name"] for model in response.json().get("models", [])}
+            else:
+                # TTS服务对不带参数的请求返回参数错误也说明服务在线
+                response = client.get(endpoint.url, timeout=timeout)
+                if response.status_code >= 500:
+                    response.raise_for_status()
+                models = None
+        except Exception as e:
+            with self.lock:
+                self._record_failure(endpoint, e)
+            if self.backend == "tts":
+                get_voice_registry().forget(endpoint.url)
+            return False
+        self.mark_ok(endpoint)
+        if models is not None:
+            with self.lock:
+                endpoint.models = models
+        return True
+
+    def status_text(self, label):
+        """节点熔断状态和平均响应延迟的简短描述"""
+        with self.lock:
+            total = len(self.endpoints)
+            opened = sum(1 for endpoint in self.endpoints if endpoint.circuit_open)
+            latencies = [
+                endpoint.latency for endpoint in self.endpoints
+                if endpoint.latency is not None and not endpoint.circuit_open
+            ]
+        if total and opened == total:
+            return f"🔴 {label}服务不可用，已暂停请求，每 {self.recovery_interval():g}秒自动检测恢复"
+        text = f"🟡 {label}：{opened}/{total} 个节点暂停使用" if opened else f"🟢 {label}正常"
+        if latencies:
+            text += f"（平均响应 {sum(latencies) / len(latencies):.2f}秒）"
+        return text
+
+    def start(self):
+        """多个节点时启动后台健康检查，check_interval 为 0 时不检查，熔断的节点单独检测恢复"""
+        if len(self.endpoints) > 1 and self.check_interval > 0 and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._check_loop, name=f"{self.backend}-health", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _check_loop(self):
+        while True:
+            for endpoint in self.endpoints:
+                self.check(endpoint)
+            if self._stop.wait(self.check_interval):
+                return
+
+_endpoint_pools = {}
+_endpoint_pools_lock = threading.Lock()
+
+def get_endpoint_urls(backend):
+    """读取后端（"ollama" 或 "tts"）配置的节点地址列表"""
+    return list(app_state.config.endpoint_urls[backend])
+
+def get_endpoint_pool(backend):
+    """获取后端的节点池，配置的地址或熔断参数变化后重建"""
+    config = app_state.config
+    urls = config.endpoint_urls[backend]
+    settings = (config.health_check_interval, config.breaker_failures, config.breaker_probe_interval)
+    with _endpoint_pools_lock:
+        pool = _endpoint_pools.get(backend)
+        if pool is None or pool.urls != urls or pool.settings != settings:
+            if pool:
+                pool.stop()
+            pool = EndpointPool(backend, urls, *settings)
+            pool.start()
+            _endpoint_pools[backend] = pool
+        return pool
+
+async def async_request_with_failover(backend, model, send):
+    """send(节点地址) 返回发出请求的协程；节点不可用或缺少模型时换下一个节点"""
+    pool = get_endpoint_pool(backend)
+    error = pool.unavailable_error()
+    for endpoint in pool.candidates(model):
+        with pool.track(endpoint):
+            start_time = time.time()
+            try:
+                response = await send(endpoint.url)
+                response.raise_for_status()
+            except Exception as e:
+                if not pool.handle_failure(endpoint, e, model):
+                    raise
+                error = e
+                continue
+            pool.mark_ok(endpoint, time.time() - start_time)
+            return response
+    raise error
+
+@asynccontextmanager
+async def async_stream_with_failover(backend, model, open_stream):
+    """打开流式响应，open_stream(节点地址) 返回响应的异步上下文管理器
+
+    只在收到响应头之前换节点；开始读取数据后出错不再转移，避免内容重复。
+    """
+    pool = get_endpoint_pool(backend)
+    error = pool.unavailable_error()
+    for endpoint in pool.candidates(model):
+        with pool.track(endpoint):
+            async with AsyncExitStack() as stack:
+                start_time = time.time()
+                try:
+                    response = await stack.enter_async_context(open_stream(endpoint.url))
+                    response.raise_for_status()
+                except Exception as e:
+                    if not pool.handle_failure(endpoint, e, model):
+                        raise
+                    error = e
+                    continue
+                pool.mark_ok(endpoint, time.time() - start_time)
+                yield response
+                return
+    raise error
+
+# ======================
+# 语音合成缓存
+# ======================
+class TTSCache:
+    """按内容寻址的语音合成缓存：内存索引 + 磁盘WAV文件，按总字节数做LRU淘汰"""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()  # key -> 文件字节数，按最近使用排序
+        self.total_bytes = 0
+        self.inflight = {}  # key -> Future，相同请求只有一个会真正调用后端
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith(".wav"):
+                path = os.path.join(cache_dir, name)
+                entries.append((os.path.getmtime(path), name[:-4], os.path.getsize(path)))
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+            self.total_bytes += size
+        with self.lock:
+            self._evict()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}.wav")
+
+    async def get_or_create_async(self, key, create):
+        """返回缓存的音频文件路径；未命中时执行 create(path) 协程写入文件"""
+        while True:
+            path, future, owner = self._acquire(key)
+            if path:
+                return path
+            if owner:
+                break
+            # 相同内容正在合成，等待其结果即可；发起合成的对话被取消时重新合成
+            try:
+                return await asyncio.wrap_future(future)
+            except TurnCancelled:
+                continue
+
+        tmp_path = f"{self.path_for(key)}.{uuid.uuid4().hex}.tmp"
+        try:
+            await create(tmp_path)
+        except BaseException as e:
+            self._abort(key, tmp_path, future, e)
+            raise
+        return self._commit(key, tmp_path, future)
+
+    def _acquire(self, key):
+        """查找缓存；未命中时登记进行中的请求，返回 (路径, Future, 是否由调用方合成)"""
+        path = self.path_for(key)
+        with self.lock:
+            if key in self.index and os.path.exists(path):
+                self.index.move_to_end(key)
+                self.hits += 1
+                return path, None, False
+
+            future = self.inflight.get(key)
+            if future is not None:
+                self.hits += 1
+                return None, future, False
+
+            future = Future()
+            self.inflight[key] = future
+            self.misses += 1
+            return None, future, True
+
+    def _commit(self, key, tmp_path, future):
+        path = self.path_for(key)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.total_bytes -= self.index.pop(key, 0)
+            self.index[key] = os.path.getsize(path)
+            self.total_bytes += self.index[key]
+            self._evict(keep=key)
+            self.inflight.pop(key, None)
+        future.set_result(path)
+        return path
+
+    def _abort(self, key, tmp_path, future, error):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        with self.lock:
+            self.inflight.pop(key, None)
+        if isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            future.set_exception(TurnCancelled("语音合成已取消"))
+
+    def resize(self, max_bytes):
+        """修改大小上限，超出时立即淘汰"""
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self, keep=None):
+        """淘汰最久未使用的文件，直到总大小不超过上限（调用方需持有锁）"""
+        while self.total_bytes > self.max_bytes and self.index:
+            key = next(iter(self.index))
+            if key == keep:
+                break
+            self.total_bytes -= self.index.pop(key)
+            try:
+                os.remove(self.path_for(key))
+            except OSError:
+                pass
+
+    def stats_text(self):
+        return f"命中 {self.hits} / 未命中 {self.misses}"
+
+_tts_cache = None
+_tts_cache_lock = threading.Lock()
+
+def get_tts_cache():
+    """获取语音合成缓存，未启用时返回 None；缓存目录或大小上限修改后按新配置使用"""
+    global _tts_cache
+    config = app_state.config
+    if not config.tts_cache:
+        return None
+    max_bytes = int(config.tts_cache_max_mb * 1024 * 1024)
+    with _tts_cache_lock:
+        if _tts_cache is None or _tts_cache.cache_dir != config.tts_cache_dir:
+            _tts_cache = TTSCache(config.tts_cache_dir, max_bytes)
+        elif _tts_cache.max_bytes != max_bytes:
+            _tts_cache.resize(max_bytes)
+        return _tts_cache
+
+def get_cache_stats():
+    """返回文本回复缓存和语音缓存的命中统计文本"""
+    if not app_state.config:
+        return ""
+    parts = []
+    response_cache = get_response_cache()
+    if response_cache:
+        parts.append(f"回复 {response_cache.stats_text()}")
+    tts_cache = get_tts_cache()
+    if tts_cache:
+        parts.append(f"语音 {tts_cache.stats_text()}")
+    return "；".join(parts)
+
+# ======================
+# 文本回复缓存
+# ======================
+class ResponseCache:
+    """文本回复缓存：按规范化的提示词、模型和请求参数缓存完整回复
+
+    条目超过 ttl 秒后失效，条目数超过上限时淘汰最久未使用的条目；
+    写入后在后台线程中延迟 SAVE_DELAY 秒合并保存到JSON文件，退出时保存未写入的条目，重启后继续使用。
+    """
+
+    # 结尾的这些标点和空白不影响回复，如 "你好" 与 "你好！"
+    TRAILING_CHARS = " ,.!?~;:，。！？～；：…、"
+    # 写入后等待多久再保存，期间的写入合并为一次保存
+    SAVE_DELAY = 2.0
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (回复原文, 写入时间)，按最近使用排序
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self._dirty = False
+
+        now = time.time()
+        try:
+            with open(path, encoding="utf-8") as f:
+                items = json.load(f)
+            if not isinstance(items, list):
+                raise ValueError("应为条目列表")
+            for item in items:
+                # 跳过格式不对的条目：[缓存键, 回复原文, 写入时间]
+                if not (isinstance(item, list) and len(item) == 3):
+                    continue
+                key, text, created = item
+                if not (isinstance(key, str) and isinstance(text, str) and isinstance(created, (int, float))):
+                    continue
+                if now - created < ttl:
+                    self.entries[key] = (text, created)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"读取回复缓存失败，将重新建立: {str(e)}")
+            self.entries.clear()
+        with self.lock:
+            self._evict()
+        atexit.register(self.flush)
+
+    @classmethod
+    def normalize_prompt(cls, text):
+        """统一全角半角、大小写和空白，去掉结尾标点"""
+        text = unicodedata.normalize("NFKC", text).casefold()
+        return " ".join(text.split()).rstrip(cls.TRAILING_CHARS)
+
+    @classmethod
+    def make_key(cls, endpoint, data):
+        """由接口名和请求体计算缓存键，不影响回复内容的字段不参与计算"""
+        data = {k: v for k, v in data.items() if k not in ("stream", "keep_alive")}
+        if "prompt" in data:
+            data["prompt"] = cls.normalize_prompt(data["prompt"])
+        else:
+            last = dict(data["messages"][-1])
+            last["content"] = cls.normalize_prompt(last["content"])
+            data["messages"] = data["messages"][:-1] + [last]
+        payload = json.dumps([endpoint, data], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """返回缓存的回复原文，未命中或已过期时返回 None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[1] >= self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                METRIC_RESPONSE_CACHE.inc(result="miss")
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        METRIC_RESPONSE_CACHE.inc(result="hit")
+        return entry[0]
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (text, time.time())
+            self._evict()
+            self._dirty = True
+            # 不在调用方（通常是事件循环）中写文件，由定时器线程合并保存
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.SAVE_DELAY, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def configure(self, ttl, max_entries):
+        """修改过期时间和条目上限，超出上限时立即淘汰"""
+        with self.lock:
+            self.ttl = ttl
+            self.max_entries = max_entries
+            self._evict()
+
+    def _evict(self):
+        """淘汰最久未使用的条目，直到不超过上限（调用方需持有锁）"""
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def flush(self):
+        """立即保存尚未写入文件的条目（定时器到期、替换缓存或退出时调用）"""
+        with self.lock:
+            timer, self._save_timer = self._save_timer, None
+            dirty, self._dirty = self._dirty, False
+        if timer and timer is not threading.current_thread():
+            timer.cancel()
+        if dirty:
+            self.save()
+
+    def save(self):
+        """写入临时文件后替换，保存过程中被中断不会损坏已有的缓存文件"""
+        with self._save_lock:
+            with self.lock:
+                items = [[key, text, created] for key, (text, created) in self.entries.items()]
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(items, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"保存回复缓存失败: {str(e)}")
+
+    def stats_text(self):
+        return f"命中 {self.hits} / 未命中 {self.misses}"
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache(model=None):
+    """获取文本回复缓存，未启用或 model 在排除列表中时返回 None"""
+    global _response_cache
+    config = app_state.config
+    if not config.response_cache:
+        return None
+    # response_cache_exclude 中的模型回复需要多样性，不使用缓存
+    if model and model in config.response_cache_exclude:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None or _response_cache.path != config.response_cache_file:
+            if _response_cache is not None:
+                _response_cache.flush()
+            _response_cache = ResponseCache(
+                config.response_cache_file, config.response_cache_ttl, config.response_cache_size
+            )
+        elif (_response_cache.ttl, _response_cache.max_entries) != (
+            config.response_cache_ttl, config.response_cache_size
+        ):
+            _response_cache.configure(config.response_cache_ttl, config.response_cache_size)
+        return _response_cache
+
+def lookup_cached_response(model, endpoint, data):
+    """查找缓存的回复，返回 (缓存键, 回复原文)；该模型不使用缓存时缓存键为 None"""
+    cache = get_response_cache(model)
+    if cache is None:
+        return None, None
+    key = cache.make_key(endpoint, data)
+    return key, cache.get(key)
+
+def store_cached_response(model, key, text):
+    """保存生成完成的回复，空回复不缓存"""
+    cache = get_response_cache(model)
+    if cache and key and text.strip():
+        cache.put(key, text)
+
+# ======================
+# 音频文件管理
+# ======================
+class AudioStore:
+    """托管的音频输出目录：唯一文件名，后台线程按存活时间和总大小清理旧文件"""
+
+    def __init__(self, audio_dir, max_age, max_bytes, interval=60):
+        self.audio_dir = audio_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._stop = threading.Event()
+        self._janitor = None
+        os.makedirs(audio_dir, exist_ok=True)
+
+    def new_path(self):
+        """返回一个不会与其他回复冲突的新文件路径"""
+        return os.path.join(self.audio_dir, f"{uuid.uuid4().hex}.wav")
+
+    def cleanup(self):
+        """删除过期文件，并在总大小超限时从最旧的文件开始删除"""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.audio_dir):
+            if not entry.is_file() or not entry.name.endswith(".wav"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                self._remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            total_bytes -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def start_janitor(self):
+        """启动后台清理线程"""
+        if self._janitor is None:
+            self._janitor = threading.Thread(target=self._run_janitor, daemon=True)
+            self._janitor.start()
+
+    def _run_janitor(self):
+        while not self._stop.is_set():
+            try:
+                self.cleanup()
+            except Exception as e:
+                print(f"清理音频文件失败: {str(e)}")
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+
+_audio_store = None
+_audio_store_lock = threading.Lock()
+
+def get_audio_store():
+    """获取共享的音频输出目录，首次使用时启动清理线程；目录修改后换用新目录"""
+    global _audio_store
+    config = app_state.config
+    max_age = config.audio_max_age_minutes * 60
+    max_bytes = int(config.audio_max_mb * 1024 * 1024)
+    with _audio_store_lock:
+        if _audio_store is None or _audio_store.audio_dir != config.audio_dir:
+            if _audio_store is not None:
+                _audio_store.stop()
+            _audio_store = AudioStore(config.audio_dir, max_age=max_age, max_bytes=max_bytes)
+            _audio_store.start_janitor()
+        else:
+            # 清理线程每轮读取最新的上限
+            _audio_store.max_age = max_age
+            _audio_store.max_bytes = max_bytes
+        return _audio_store
+
+def use_audio_in_memory():
+    """是否以 (采样率, 数组) 的形式直接把音频交给 gr.Audio，不写入音频目录
+
+    启用语音缓存时从缓存文件解码；Gradio 发送给浏览器前仍会把音频写入它自己的临时目录。
+    """
+    return app_state.config.audio_in_memory
+
+def decode_wav(data):
+    """把WAV字节解码为 gr.Audio 可直接使用的 (采样率, numpy数组)"""
+    with wave.open(io.BytesIO(data), "rb") as wav:
+        sample_rate = wav.getframerate()
+        channels = wav.getnchannels()
+        dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[wav.getsampwidth()]
+        frames = wav.readframes(wav.getnframes())
+
+    audio = np.frombuffer(frames, dtype=dtype)
+    if channels > 1:
+        audio = audio.reshape(-1, channels)
+    return sample_rate, audio
+
+# ======================
+# 声音登记
+# ======================
+class VoiceRegistry:
+    """把默认声音登记为各TTS节点的服务端默认参考音频
+
+    GPT-SoVITS 的 /change_refer 接口设置服务端默认参考音频，之后的请求只需带上文本，
+    不必每次重新提取参考音频特征。默认参考音频由整个服务共享，所以每个节点只登记配置中的默认声音；
+    会话选择的其他声音在请求中带上完整的参考音频参数。节点不可用或拒绝只带文本的请求（服务重启后
+    默认参考音频丢失）时登记失效，下次使用时重新登记。
+    """
+
+    # 后台登记失败后，同一节点至少间隔这么久（秒）再重试
+    RETRY_INTERVAL = 60
+
+    def __init__(self):
+        self.registered = {}  # 节点地址 -> 已登记声音的 reference_key
+        self.failed_at = {}  # 节点地址 -> 上次登记失败的时间
+        self._registering = set()
+        self._lock = threading.Lock()
+
+    def is_registered(self, url, voice):
+        with self._lock:
+            return self.registered.get(url) == voice.reference_key
+
+    def forget(self, url):
+        with self._lock:
+            self.registered.pop(url, None)
+
+    def register(self, voice, urls=None):
+        """在各节点上登记声音（阻塞），返回失败信息列表"""
+        errors = []
+        for url in urls or get_endpoint_urls("tts"):
+            try:
+                self._register_on(url, voice)
+            except Exception as e:
+                with self._lock:
+                    self.failed_at[url] = time.time()
+                errors.append(f"{url}: {str(e)}")
+                print(f"在 {url} 上登记声音 {voice.name} 失败: {str(e)}")
+        return errors
+
+    def register_async(self, voice, urls=None, force=False):
+        """在后台登记声音，同一节点正在登记或刚登记失败（force 为 False 时）时跳过"""
+        now = time.time()
+        with self._lock:
+            urls = [
+                url for url in urls or get_endpoint_urls("tts")
+                if url not in self._registering
+                and (force or now - self.failed_at.get(url, 0) >= self.RETRY_INTERVAL)
+            ]
+            self._registering.update(urls)
+        if urls:
+            threading.Thread(target=self._register_urls, args=(voice, urls), daemon=True).start()
+
+    def _register_urls(self, voice, urls):
+        try:
+            self.register(voice, urls)
+        finally:
+            with self._lock:
+                self._registering.difference_update(urls)
+
+    def _register_on(self, url, voice):
+        # 登记期间该节点的请求仍带完整参数
+        self.forget(url)
+        client = get_http_client("tts")
+        response = client.get(
+            url.rstrip("/") + "/change_refer", params=voice.reference_params(), timeout=client.timeout
+        )
+        response.raise_for_status()
+        with self._lock:
+            self.registered[url] = voice.reference_key
+            self.failed_at.pop(url, None)
+
+_voice_registry = None
+_voice_registry_lock = threading.Lock()
+
+def get_voice_registry():
+    """获取全局的声音登记表"""
+    global _voice_registry
+    with _voice_registry_lock:
+        if _voice_registry is None:
+            _voice_registry = VoiceRegistry()
+        return _voice_registry
+
+# ======================
+# API 服务函数
+# ======================
+def get_ollama_api_url(node_url, endpoint):
+    """由节点的 /api/generate 地址得到Ollama其他接口的地址"""
+    base_url = node_url.replace("/api/generate", "")
+    return f"{base_url}/api/{endpoint}"
+
+def get_completion_request(prompt, model, history, stream):
+    """构造生成请求，返回 (接口名, 请求体)：有对话历史时使用 chat，否则使用 generate"""
+    if history is None:
+        endpoint = "generate"
+        data = {"model": model, "prompt": prompt, "stream": stream}
+    else:
+        endpoint = "chat"
+        messages = history + [{"role": "user", "content": prompt}]
+        data = {"model": model, "messages": messages, "stream": stream}
+    data["keep_alive"] = get_keep_alive(model)
+    return endpoint, data
+
+def get_completion_text(chunk):
+    """取出 /api/generate 或 /api/chat 返回中的文本"""
+    if "message" in chunk:
+        return chunk["message"].get("content", "")
+    return chunk.get("response", "")
+
+class ModelRegistry:
+    """Ollama模型列表缓存
+
+    读取时直接返回缓存内容，缓存过期后在后台线程中重新请求 /api/tags，
+    同时记录每个模型的大小、参数量、量化方式和模型系列。
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.models = {}  # 模型名 -> 模型信息
+        self.updated_at = None
+        self.error = None
+        self._refresh_done = None
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """缓存过期（或 force）时在后台刷新，返回本次刷新完成的事件"""
+        with self._lock:
+            if self._refresh_done and not self._refresh_done.is_set():
+                return self._refresh_done
+            done = threading.Event()
+            fresh = self.updated_at is not None and time.time() - self.updated_at < self.ttl
+            if fresh and not force:
+                done.set()
+                return done
+            self._refresh_done = done
+        threading.Thread(target=self._refresh, args=(done,), daemon=True).start()
+        return done
+
+    def _refresh(self, done):
+        """汇总所有Ollama节点上的模型，并记录各节点有哪些模型"""
+        client = get_http_client("ollama")
+        pool = get_endpoint_pool("ollama")
+        models = {}
+        errors = []
+        for endpoint in pool.endpoints:
+            try:
+                response = client.get(
+                    get_ollama_api_url(endpoint.url, "tags"), timeout=(client.timeout[0], 10)
+                )
+                response.raise_for_status()
+                items = response.json().get("models", [])
+            except Exception as e:
+                errors.append(f"{endpoint.url}: {str(e)}")
+                continue
+            with pool.lock:
+                endpoint.models = {item["name"] for item in items}
+            for item in items:
+                details = item.get("details") or {}
+                models.setdefault(item["name"], {
+                    "size": item.get("size", 0),
+                    "family": details.get("family", ""),
+                    "parameter_size": details.get("parameter_size", ""),
+                    "quantization": details.get("quantization_level", ""),
+                })
+
+        with self._lock:
+            if len(errors) < len(pool.endpoints):
+                self.models = models
+                self.updated_at = time.time()
+            self.error = "; ".join(errors) or None
+        if errors:
+            print(f"获取模型列表失败: {self.error}")
+        done.set()
+
+    def names(self):
+        """返回缓存的模型名列表，并按需触发后台刷新"""
+        self.refresh()
+        with self._lock:
+            return sorted(self.models)
+
+    def describe(self, model):
+        """返回模型信息的简短描述，未知模型返回空字符串"""
+        with self._lock:
+            info = self.models.get(model)
+        if not info:
+            return ""
+        parts = [info["family"], info["parameter_size"], info["quantization"]]
+        if info["size"]:
+            parts.append(f"{info['size'] / 1024 ** 3:.1f} GB")
+        return " · ".join(part for part in parts if part)
+
+_model_registry = None
+_model_registry_lock = threading.Lock()
+
+def get_model_registry():
+    """获取全局的模型列表缓存"""
+    global _model_registry
+    ttl = app_state.config.model_list_ttl if app_state.config else 300
+    with _model_registry_lock:
+        if _model_registry is None:
+            _model_registry = ModelRegistry(ttl=ttl)
+        _model_registry.ttl = ttl
+        return _model_registry
+
+def get_ollama_models():
+    """获取本地安装的Ollama模型列表（读取缓存，不等待网络请求）"""
+    if not app_state.config or not app_state.config["API"].get("ollama_url"):
+        return []
+    return get_model_registry().names()
+
+def generate_completion(prompt, model=None, history=None, cancel=None, task=None):
+    """生成文本回复（同步接口），history 为对话历史消息（None 表示单轮），cancel 被取消时立即中断请求"""
+    return run_sync(async_generate_completion(prompt, model, history, task), cancel)
+
+async def async_generate_completion(prompt, model=None, history=None, task=None):
+    """生成文本回复，返回 (回复, 耗时, 模型)
+
+    task 为后台任务名（如 "summary"）时耗时单独记录，不计入对话的文本生成指标。
+    """
+    if not app_state.config or not app_state.config["API"].get("ollama_url"):
+        raise gr.Error("Ollama API地址未配置！请先完成配置")
+
+    if not model:
+        model = app_state.config.default_model
+
+    start_time = time.time()
+    endpoint, data = get_completion_request(prompt, model, history, stream=False)
+    cache_key, cached = lookup_cached_response(model, endpoint, data)
+    if cached is not None:
+        cleaned_response, _ = split_think(cached)
+        return cleaned_response, time.time() - start_time, model
+
+    try:
+        client = get_async_http_client("ollama")
+        timeout = get_ollama_timeout(client, model)
+        response = await async_request_with_failover(
+            "ollama",
+            model,
+            lambda url: client.post(get_ollama_api_url(url, endpoint), json=data, timeout=timeout),
+        )
+        elapsed = time.time() - start_time
+        get_model_warmer().touch(model)
+        result = response.json()
+        if task:
+            METRIC_LLM_BACKGROUND.observe(elapsed, model=model, task=task)
+        else:
+            # 非流式请求要等完整回复，首字延迟即生成耗时
+            record_completion_metrics(model, elapsed, elapsed, result)
+
+        raw_response = get_completion_text(result)
+        store_cached_response(model, cache_key, raw_response)
+        # 移除<think></think>标签及其内容
+        cleaned_response, _ = split_think(raw_response)
+
+        return cleaned_response, elapsed, model
+    except Exception as e:
+        raise gr.Error(f"生成回复时出错: {str(e)}")
+
+class CompletionStream:
+    """流式生成文本回复，用 async for 逐块读取Ollama返回的NDJSON并记录首字延迟
+
+    传入 cancel 时在单独的任务中读取，取消后立即中断请求。
+    """
+
+    def __init__(self, prompt, model=None, history=None, cancel=None):
+        if not app_state.config or not app_state.config["API"].get("ollama_url"):
+            raise gr.Error("Ollama API地址未配置！请先完成配置")
+
+        self.prompt = prompt
+        self.cancel = cancel
+        self.model = model or app_state.config.default_model
+        self.history = history
+        self.first_token_elapsed = None
+        self.elapsed = None
+        self.start_time = None
+        self.reply_tokens = None
+        self.stats = {}
+        self.cache_key = None
+        self.cached = False
+        self.tokens = []
+
+    def _request(self):
+        endpoint, data = get_completion_request(self.prompt, self.model, self.history, stream=True)
+        self.cache_key, cached = lookup_cached_response(self.model, endpoint, data)
+        if cached is not None:
+            # 命中缓存时整段回复作为一个片段返回，不再请求Ollama
+            self.cached = True
+            self.first_token_elapsed = time.time() - self.start_time
+            self.tokens = [cached]
+        return endpoint, data
+
+    def _parse_line(self, line):
+        """解析一行NDJSON，返回其中的文本片段"""
+        if not line:
+            return ""
+        chunk = json.loads(line)
+        if chunk.get("error"):
+            raise RuntimeError(chunk["error"])
+
+        if chunk.get("done"):
+            self.stats = chunk
+            self.reply_tokens = chunk.get("eval_count")
+        token = get_completion_text(chunk)
+        if token:
+            self.tokens.append(token)
+            if self.first_token_elapsed is None:
+                self.first_token_elapsed = time.time() - self.start_time
+        return token
+
+    def _finish(self):
+        """完整读取回复后记录指标并写入缓存"""
+        record_completion_metrics(
+            self.model, time.time() - self.start_time, self.first_token_elapsed, self.stats
+        )
+        store_cached_response(self.model, self.cache_key, "".join(self.tokens))
+
+    def __aiter__(self):
+        if self.cancel:
+            return self.cancel.aiter(self._aiter())
+        return self._aiter()
+
+    async def _aiter(self):
+        self.start_time = time.time()
+        endpoint, data = self._request()
+
+        try:
+            if self.cached:
+                for token in self.tokens:
+                    yield token
+                return
+            client = get_async_http_client("ollama")
+            timeout = get_ollama_timeout(client, self.model)
+            open_stream = lambda url: client.stream(
+                "POST", get_ollama_api_url(url, endpoint), json=data, timeout=timeout
+            )
+            async with async_stream_with_failover("ollama", self.model, open_stream) as response:
+                async for line in response.aiter_lines():
+                    token = self._parse_line(line)
+                    if token:
+                        yield token
+            get_model_warmer().touch(self.model)
+            self._finish()
+        except Exception as e:
+            raise gr.Error(f"生成回复时出错: {str(e)}")
+        finally:
+            self.elapsed = time.time() - self.start_time
+
+class ThinkFilter:
+    """增量分离<think></think>思考内容
+
+    逐片段输入模型输出，按标签切换状态，分别返回新增的可见文本和思考内容。
+    标签可能被拆在两个片段之间，片段末尾可能是标签开头的部分先暂存，
+    等下一个片段到达后再判断。
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.in_think = False
+        self.pending = ""
+
+    @staticmethod
+    def _partial_tag_length(text, tag):
+        """返回 text 末尾与 tag 开头重合的长度"""
+        for size in range(min(len(tag) - 1, len(text)), 0, -1):
+            if text.endswith(tag[:size]):
+                return size
+        return 0
+
+    def feed(self, chunk):
+        """输入一个片段，返回 (新增可见文本, 新增思考内容)"""
+        text = self.pending + chunk
+        self.pending = ""
+        visible, thinking = [], []
+        while text:
+            target = thinking if self.in_think else visible
+            tag = self.CLOSE_TAG if self.in_think else self.OPEN_TAG
+            index = text.find(tag)
+            if index < 0:
+                keep = self._partial_tag_length(text, tag)
+                target.append(text[:len(text) - keep])
+                self.pending = text[len(text) - keep:]
+                break
+            target.append(text[:index])
+            text = text[index + len(tag):]
+            self.in_think = not self.in_think
+        return "".join(visible), "".join(thinking)
+
+    def flush(self):
+        """输出结束：交还暂存的部分，返回 (可见文本, 思考内容)"""
+        rest, self.pending = self.pending, ""
+        return ("", rest) if self.in_think else (rest, "")
+
+def split_think(text):
+    """把完整回复拆分为 (可见文本, 思考内容)，未闭合的<think>视为思考内容"""
+    think_filter = ThinkFilter()
+    visible, thinking = think_filter.feed(text)
+    rest_visible, rest_thinking = think_filter.flush()
+    return visible + rest_visible, thinking + rest_thinking
+
+def check_tts_config():
+    """语音合成前检查配置"""
+    if not app_state.config:
+        raise gr.Error("配置未加载，无法进行语音合成")
+
+    missing = app_state.check_config()
+    if missing:
+        raise gr.Error(f"配置不完整，无法进行语音合成。缺少: {', '.join(missing)}")
+
+def get_tts_params(text, voice, url=None):
+    """构造TTS服务的请求参数
+
+    声音已登记为节点 url 的默认参考音频时只发送文本；默认声音尚未登记时在后台登记，
+    本次请求仍带完整的参考音频参数。
+    """
+    params = {"text": text, "text_language": voice.text_language}
+    registry = get_voice_registry()
+    if url is None or not registry.is_registered(url, voice):
+        params.update(voice.reference_params())
+        if url and voice.reference_key == app_state.config.get_voice().reference_key:
+            registry.register_async(voice, [url])
+    return params
+
+@asynccontextmanager
+async def open_tts_stream(client, text, voice, url):
+    """在节点 url 上打开合成请求的响应
+
+    只发送文本的请求被拒绝（4xx）时，服务可能已重启、登记的默认参考音频已丢失：
+    忘记该节点的登记，带完整的参考音频参数重试一次，并在后台重新登记。
+    """
+    params = get_tts_params(text, voice, url)
+    async with client.stream("GET", url, params=params) as response:
+        if "refer_wav_path" in params or not 400 <= response.status_code < 500:
+            yield response
+            return
+    print(f"tts 节点 {url} 拒绝了只带文本的请求（{response.status_code}），重新登记声音")
+    get_voice_registry().forget(url)
+    async with client.stream("GET", url, params=get_tts_params(text, voice, url)) as response:
+        yield response
+
+def get_tts_cache_key(text, voice):
+    """计算语音缓存键：文本、参考音频设置与服务地址共同决定合成结果"""
+    return TTSCache.make_key(
+        text,
+        voice.reference_wav,
+        voice.prompt_text,
+        voice.prompt_language,
+        voice.text_language,
+        app_state.config["API"]["tts_url"],
+    )
+
+TTS_CHUNK_SIZE = 64 * 1024
+
+def open_audio_target(audio_file):
+    """audio_file 可以是文件路径，也可以是已打开的二进制文件对象"""
+    if hasattr(audio_file, "write"):
+        return nullcontext(audio_file)
+    return open(audio_file, "wb")
+
+def download_tts_audio(text, audio_file, on_chunk=None, voice=None, cancel=None):
+    """请求TTS服务合成语音并写入指定文件（同步接口），cancel 被取消时立即中断请求"""
+    run_sync(async_download_tts_audio(text, audio_file, on_chunk, voice), cancel)
+
+async def async_download_tts_audio(text, audio_file, on_chunk=None, voice=None):
+    """请求TTS服务合成语音，边接收边写入指定文件
+
+    audio_file 可以是文件路径或二进制文件对象；每收到一块数据都会调用 on_chunk(chunk)，
+    内存占用与音频长度无关。voice 为空时使用默认声音。
+    """
+    client = get_async_http_client("tts")
+    voice = voice or app_state.config.get_voice()
+    open_stream = lambda url: open_tts_stream(client, text, voice, url)
+    start_time = time.time()
+    header = b""
+    total_bytes = 0
+    async with async_stream_with_failover("tts", None, open_stream) as response:
+        with open_audio_target(audio_file) as f:
+            async for chunk in response.aiter_bytes(TTS_CHUNK_SIZE):
+                f.write(chunk)
+                if len(header) < 44:
+                    header += chunk[:44 - len(header)]
+                total_bytes += len(chunk)
+                if on_chunk:
+                    on_chunk(chunk)
+    record_tts_metrics(time.time() - start_time, header, total_bytes)
+
+def tts_service(text, on_chunk=None, voice=None, cancel=None):
+    """调用TTS服务生成语音（同步接口），cancel 被取消时抛出 TurnCancelled"""
+    return run_sync(async_tts_service(text, on_chunk, voice), cancel)
+
+async def async_tts_service(text, on_chunk=None, voice=None):
+    """调用TTS服务生成语音，voice 为空时使用默认声音
+
+    返回 (音频, 耗时)。音频通常是文件路径；启用内存模式时为 (采样率, 数组)，不写入音频目录。
+    传入 on_chunk 时调用方自己转发音频数据，使用缓存时仍返回缓存文件路径。
+    """
+    check_tts_config()
+    start_time = time.time()
+    voice = voice or app_state.config.get_voice()
+
+    try:
+        cache = get_tts_cache()
+        if cache:
+            audio_file = await cache.get_or_create_async(
+                get_tts_cache_key(text, voice),
+                lambda path: async_download_tts_audio(text, path, on_chunk, voice),
+            )
+            if use_audio_in_memory() and on_chunk is None:
+                # 缓存文件由缓存管理，交给界面的是解码后的数组
+                with open(audio_file, "rb") as f:
+                    audio_file = decode_wav(f.read())
+        elif use_audio_in_memory():
+            buffer = io.BytesIO()
+            await async_download_tts_audio(text, buffer, on_chunk, voice)
+            audio_file = decode_wav(buffer.getvalue())
+        else:
+            audio_file = get_audio_store().new_path()
+            await async_download_tts_audio(text, audio_file, on_chunk, voice)
+
+        elapsed = time.time() - start_time
+        return audio_file, elapsed
+    except TurnCancelled:
+        raise
+    except Exception as e:
+        raise gr.Error(f"语音合成失败: {str(e)}")
+
+# ======================
+# 模型预热
+# ======================
+def get_keep_alive(model):
+    """返回发送给Ollama的 keep_alive，model_keep_alive 中可按模型单独指定"""
+    keep_alive, _ = app_state.config.get_keep_alive(model)
+    return keep_alive
+
+def get_model_load_timeout():
+    return app_state.config.model_load_timeout
+
+def get_ollama_timeout(client, model):
+    """模型尚未加载时放宽读取超时，请求需要等待模型加载"""
+    if get_model_warmer().is_ready(model):
+        return client.timeout
+    return httpx.Timeout(get_model_load_timeout(), connect=client.timeout.connect)
+
+class ModelWarmer:
+    """在后台预加载Ollama模型，并记录各模型的加载状态
+
+    Ollama 在模型最后一次使用 keep_alive 时长后将其卸载，已加载的状态同样在此之后过期。
+    """
+
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self):
+        self.states = {}  # 模型 -> (状态, 加载耗时或错误信息)
+        self.last_used = {}  # 模型 -> 最后一次加载或使用的时间
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def _state(self, model):
+        """在持有锁时调用，返回模型的状态，已过期的加载状态视为未加载"""
+        state = self.states.get(model)
+        if state and state[0] == self.READY:
+            _, seconds = app_state.config.get_keep_alive(model)
+            if seconds is not None and time.time() - self.last_used.get(model, 0) > seconds:
+                del self.states[model]
+                return None
+        return state
+
+    def warm(self, model):
+        """开始预加载模型（正在加载时不重复请求），返回加载完成的事件"""
+        with self._lock:
+            state = self._state(model)
+            if state and state[0] == self.LOADING:
+                return self._events[model]
+            # 已加载的模型也重新请求一次，以刷新 keep_alive
+            done = threading.Event()
+            self._events[model] = done
+            if not state or state[0] != self.READY:
+                self.states[model] = (self.LOADING, None)
+        threading.Thread(target=self._load, args=(model, done), daemon=True).start()
+        return done
+
+    def _load(self, model, done):
+        """在所有可能有该模型的节点上加载，任一节点成功即视为已加载"""
+        start_time = time.time()
+        client = get_http_client("ollama")
+        pool = get_endpoint_pool("ollama")
+        state = (self.FAILED, "没有可用的节点")
+        for endpoint in pool.candidates(model):
+            if endpoint.models is not None and model not in endpoint.models:
+                continue
+            # 已在可用节点上加载成功时跳过不健康的节点
+            if state[0] == self.READY and not endpoint.healthy:
+                continue
+            try:
+                # 不带 prompt 的生成请求只加载模型
+                response = client.post(
+                    get_ollama_api_url(endpoint.url, "generate"),
+                    json={"model": model, "stream": False, "keep_alive": get_keep_alive(model)},
+                    timeout=(client.timeout[0], get_model_load_timeout()),
+                )
+                response.raise_for_status()
+                state = (self.READY, time.time() - start_time)
+            except Exception as e:
+                print(f"在 {endpoint.url} 上预加载模型 {model} 失败: {str(e)}")
+                if state[0] != self.READY:
+                    state = (self.FAILED, str(e))
+        with self._lock:
+            self.states[model] = state
+            if state[0] == self.READY:
+                self.last_used[model] = time.time()
+        done.set()
+
+    def touch(self, model):
+        """记录模型刚被使用过：生成请求成功说明模型已加载，Ollama 重新计算 keep_alive"""
+        with self._lock:
+            self.last_used[model] = time.time()
+            state = self._state(model)
+            if not state or state[0] == self.FAILED:
+                self.states[model] = (self.READY, None)
+
+    def reset(self):
+        """忘记所有模型的加载状态（节点地址变化后调用）"""
+        with self._lock:
+            self.states = {
+                model: state for model, state in self.states.items() if state[0] == self.LOADING
+            }
+            self.last_used = {}
+
+    def is_ready(self, model):
+        with self._lock:
+            state = self._state(model)
+        return bool(state) and state[0] == self.READY
+
+    def status_text(self, model):
+        """返回模型加载状态的提示文本"""
+        with self._lock:
+            state, detail = self._state(model) or (None, None)
+        if state == self.LOADING:
+            return f"⏳ 正在加载模型 {model}..."
+        if state == self.READY and detail is None:
+            return f"✅ 模型 {model} 已加载"
+        if state == self.READY:
+            return f"✅ 模型 {model} 已加载（{detail:.1f}秒）"
+        if state == self.FAILED:
+            return f"❌ 模型 {model} 加载失败: {detail}"
+        return f"模型 {model} 尚未加载"
+
+_model_warmer = None
+_model_warmer_lock = threading.Lock()
+
+def get_model_warmer():
+    """获取全局的模型预热器"""
+    global _model_warmer
+    with _model_warmer_lock:
+        if _model_warmer is None:
+            _model_warmer = ModelWarmer()
+        return _model_warmer
+
+def use_model_warmup():
+    return bool(app_state.config) and app_state.config.warmup_models
+
+# ======================
+# 请求调度
+# ======================
+class SchedulerFull(Exception):
+    """排队请求已达上限，新请求被拒绝"""
+
+
+class StageTicket:
+    """调度器中的一个请求：排队等待，获得名额后执行，结束后释放名额"""
+
+    def __init__(self, scheduler, session_id, background=False):
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.background = background  # 后台任务（如对话摘要），优先级低于用户请求
+        self.enqueued_at = time.time()
+        self.granted = threading.Event()
+        self.settled = threading.Event()  # 已获得名额或已放弃排队
+        self.released = False
+        self._waiters = []
+
+    def _settle(self):
+        """由调度器在持有锁时调用，唤醒所有等待者"""
+        self.settled.set()
+        for loop, waiter in self._waiters:
+            loop.call_soon_threadsafe(_resolve_waiter, waiter)
+        self._waiters = []
+
+    def _grant(self):
+        """由调度器在持有锁时调用"""
+        self.granted.set()
+        # 后台任务的排队时间单独记录，不计入用户请求的排队时间
+        stage = f"{self.scheduler.stage}_background" if self.background else self.scheduler.stage
+        METRIC_QUEUE_WAIT.observe(time.time() - self.enqueued_at, stage=stage)
+        self._settle()
+
+    def wait(self, timeout=None):
+        """等待获得名额，超时或在排队时被放弃返回 False"""
+        self.settled.wait(timeout)
+        return self.granted.is_set()
+
+    async def wait_async(self, timeout=None):
+        """在事件循环中等待获得名额，超时或在排队时被放弃返回 False"""
+        loop = asyncio.get_running_loop()
+        with self.scheduler.lock:
+            if self.settled.is_set():
+                return self.granted.is_set()
+            # 超时后再次等待时复用同一个 future
+            for waiter_loop, waiter in self._waiters:
+                if waiter_loop is loop:
+                    break
+            else:
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.granted.is_set()
+
+    def release(self):
+        """释放名额，或放弃排队（可重复调用）"""
+        self.scheduler.release(self)
+
+    def status_text(self, label=""):
+        """排队状态提示，label 为排队的内容（如“语音”）"""
+        waited = time.time() - self.enqueued_at
+        return f"⏳ {label}排队中：第 {self.scheduler.position(self)} 位，已等待 {waited:.1f}秒"
+
+
+class StageScheduler:
+    """单个处理阶段（文本生成或语音合成）的请求调度器
+
+    同时执行的请求不超过 limit，其余请求按会话分组排队，各会话轮流获得名额，
+    一个会话的大量请求不会拖慢其他会话；排队请求达到 max_queue 时直接拒绝。
+    后台任务单独排队，没有用户请求在排队时才获得名额，也不占用队列上限。
+    """
+
+    def __init__(self, name, limit, max_queue, stage=""):
+        self.name = name
+        self.stage = stage
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self.running = 0
+        self.waiting = 0
+        self.queues = OrderedDict()  # 会话 -> 排队的请求，顺序即轮转顺序
+        self.background = deque()  # 排队的后台任务
+        self.lock = threading.Lock()
+
+    def enqueue(self, session_id, admitted=False, background=False):
+        """加入队列，有空闲名额时立即获得；队列已满时抛出 SchedulerFull
+
+        admitted 为 True 表示所属的工作已被接纳（如一轮语音中第一个句子之后的句子），不受队列上限限制。
+        background 为 True 表示后台任务，排在所有用户请求之后，不受队列上限限制。
+        """
+        ticket = StageTicket(self, session_id, background)
+        with self.lock:
+            if self.running < self.limit and not self.waiting:
+                self.running += 1
+                ticket._grant()
+                return ticket
+            if background:
+                self.background.append(ticket)
+                return ticket
+            if self.waiting >= self.max_queue and not admitted:
+                METRIC_QUEUE_REJECTED.inc(stage=self.stage)
+                raise SchedulerFull(f"{self.name}繁忙，已有 {self.waiting} 个请求在排队，请稍后再试")
+            self.queues.setdefault(session_id, deque()).append(ticket)
+            self.waiting += 1
+        return ticket
+
+    def release(self, ticket):
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted.is_set():
+                self.running -= 1
+            elif ticket.background:
+                self.background.remove(ticket)
+                ticket._settle()
+            else:
+                tickets = self.queues.get(ticket.session_id)
+                tickets.remove(ticket)
+                self.waiting -= 1
+                if not tickets:
+                    del self.queues[ticket.session_id]
+                ticket._settle()
+            self._dispatch()
+
+    def _dispatch(self):
+        """把空闲名额按会话轮流分配给排队的请求"""
+        while self.running < self.limit and self.queues:
+            session_id, tickets = self.queues.popitem(last=False)
+            ticket = tickets.popleft()
+            self.waiting -= 1
+            # 该会话还有请求时排到队尾，等其他会话各执行一个
+            if tickets:
+                self.queues[session_id] = tickets
+            self.running += 1
+            ticket._grant()
+        # 用户请求都已获得名额后才轮到后台任务
+        while self.running < self.limit and self.background:
+            self.running += 1
+            self.background.popleft()._grant()
+
+    def resize(self, limit, max_queue):
+        """修改并发数和队列上限，已排队的请求不受影响"""
+        with self.lock:
+            self.limit = max(1, limit)
+            self.max_queue = max(0, max_queue)
+            self._dispatch()
+
+    def position(self, ticket):
+        """返回请求在队列中的位置（从1开始），已获得名额时返回 0"""
+        with self.lock:
+            if ticket.granted.is_set() or ticket.released:
+                return 0
+            if ticket.background:
+                return self.waiting + self.background.index(ticket) + 1
+            index = self.queues[ticket.session_id].index(ticket)
+            # 每一轮各会话依次执行一个请求：前 index 轮加上本轮排在前面的会话
+            position = 1
+            ahead = True
+            for session_id, tickets in self.queues.items():
+                position += min(len(tickets), index)
+                if session_id == ticket.session_id:
+                    ahead = False
+                elif ahead and len(tickets) > index:
+                    position += 1
+            return position
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler_limits(stage):
+    """读取阶段的并发数和队列上限"""
+    config = app_state.config
+    if stage == "llm":
+        return config.llm_concurrency, config.llm_queue_size
+    return config.tts_concurrency, config.tts_queue_size
+
+def get_scheduler(stage):
+    """获取指定阶段（"llm" 或 "tts"）的调度器"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(stage)
+        if scheduler is None:
+            name = "文本生成" if stage == "llm" else "语音合成"
+            scheduler = StageScheduler(name, *get_scheduler_limits(stage), stage=stage)
+            _schedulers[stage] = scheduler
+        return scheduler
+
+def resize_schedulers():
+    """按最新配置调整已创建的调度器"""
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    for stage, scheduler in schedulers.items():
+        scheduler.resize(*get_scheduler_limits(stage))
+
+# ======================
+# 分句语音合成流水线
+# ======================
+class SentenceSplitter:
+    """按中英文标点将流式文本切分为完整句子"""
+
+    # 句末标点（可带右引号/括号），英文句点需后接空白以避开小数和缩写
+    SENTENCE_END = re.compile(r'[。！？!?；;…\n]+[”’"\'」』）)]*|\.+(?=\s)')
+
+    def __init__(self, min_chars=4):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text):
+        """追加文本，返回已完整的句子列表"""
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in self.SENTENCE_END.finditer(self.buffer):
+            # 标点位于缓冲区末尾时可能还有后续标点或引号，等待下一块
+            if match.end() == len(self.buffer):
+                break
+            sentence = self.buffer[start:match.end()].strip()
+            # 过短的句子并入下一句，避免产生大量零碎的合成请求
+            if len(sentence) >= self.min_chars:
+                sentences.append(sentence)
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self):
+        """返回缓冲区中剩余的文本"""
+        sentence = self.buffer.strip()
+        self.buffer = ""
+        return [sentence] if sentence else []
+
+async def async_scheduled_tts_service(ticket, text, on_chunk=None, voice=None):
+    """获得语音合成名额后执行合成，排队时被放弃则抛出 TurnCancelled；取消时由流水线取消任务"""
+    try:
+        if not await ticket.wait_async():
+            raise TurnCancelled()
+        return await async_tts_service(text, on_chunk, voice)
+    finally:
+        ticket.release()
+
+class WavStreamJoiner:
+    """把多段WAV音频拼接为一路可连续播放的字节流
+
+    只保留第一段的文件头并把其中的长度字段标记为未知，后续各段去掉文件头。
+    """
+
+    HEADER_SIZE = 44
+
+    def __init__(self):
+        self.first_segment = True
+        self.header = None
+
+    def start_segment(self):
+        self.header = b""
+
+    def feed(self, chunk):
+        """输入当前段的一块数据，返回可直接转发的字节"""
+        if self.header is None:
+            return chunk
+
+        self.header += chunk
+        if len(self.header) < self.HEADER_SIZE:
+            return b""
+        header, body = self.header[:self.HEADER_SIZE], self.header[self.HEADER_SIZE:]
+        self.header = None
+        if not self.first_segment:
+            return body
+        self.first_segment = False
+        unknown = b"\xff\xff\xff\xff"
+        return header[:4] + unknown + header[8:40] + unknown + body
+
+class PipelineSegment:
+    """流水线中的一个句子：合成结果及实时转发的音频数据块"""
+
+    def __init__(self, sentence, future):
+        self.sentence = sentence
+        self.future = future  # 句子交给调度器之前就已创建，输出端按顺序等待
+        self.on_chunk = None
+        self.chunks = asyncio.Queue()
+        self.streamed = False
+
+    def put_chunk(self, chunk):
+        self.streamed = True
+        self.chunks.put_nowait(chunk)
+
+class TTSPipeline:
+    """分句语音合成流水线：句子完整后立即提交合成，音频片段按顺序输出
+
+    各句子在当前事件循环中以任务方式合成，需在事件循环线程中创建和提交。
+    stream_chunks 为 True 时边下载边转发音频数据块，第一块到达即可开始播放。
+    cancel() 放弃排队中的句子并中断合成中的请求。
+
+    一轮回复同时交给调度器的句子不超过语音合成并发数，其余句子在流水线中等待，
+    长回复不会占满全局队列。第一个句子被调度器接纳后，本轮后续句子不再因队列已满被拒绝；
+    第一个句子被拒绝时整轮语音以同样的错误结束。
+    """
 
-# ======================
-# 全局状态管理类
-# ======================
-class AppState:
-    def __init__(self):
-        self.config_file = "config.ini"
-        self.first_run = not os.path.exists(self.config_file)
-        self.config = None
-        self.audio_generated = threading.Event()
-        self.audio_file_path = None
-        self.tts_error = None
-        self.tts_elapsed = None
-        self.audio_ready = False
-        
-    def load_config(self):
-        """加载配置文件"""
-        if not os.path.exists(self.config_file):
-            return None
+    def __init__(self, on_complete=None, stream_chunks=False, session_id=None, voice=None):
+        self.start_time = time.time()
+        self.session_id = session_id
+        self.voice = voice
+        self.on_complete = on_complete
+        self.loop = asyncio.get_running_loop()
+        self.stream_chunks = stream_chunks
+        self.cancelled = False
+        self.futures = []
+        self.tickets = []
+        self.tasks = []
+        self.waiting = deque()  # 尚未交给调度器的句子
+        self.outstanding = 0  # 已交给调度器、尚未结束的句子数
+        self.max_outstanding = get_scheduler("tts").limit
+        self.admitted = False
+        self.rejected = None
+        self.segments = asyncio.Queue()
+        self.errors = []
+        self.first_audio_elapsed = None
+        self.elapsed = None
+        self.closed = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
 
-        config = configparser.ConfigParser()
-        config.read(self.config_file)
+    def submit(self, sentence):
+        """提交一个句子进行合成"""
+        if self.cancelled:
+            return
+        segment = PipelineSegment(sentence, self.loop.create_future())
+        is_first = not self.futures
+        if self.stream_chunks:
+            def on_chunk(chunk):
+                if is_first and self.first_audio_elapsed is None:
+                    self.first_audio_elapsed = time.time() - self.start_time
+                segment.put_chunk(chunk)
+            segment.on_chunk = on_chunk
 
-        self.config = {
-            "API": {
-                "ollama_url": config.get("API", "ollama_url", fallback=""),
-                "tts_url": config.get("API", "tts_url", fallback=""),
-                "default_model": config.get("API", "default_model", fallback="qwen2.5vl:latest"),
-            },
-            "TTS": {
-                "reference_wav": config.get("TTS", "reference_wav", fallback=""),
-                "prompt_text": config.get("TTS", "prompt_text", fallback=""),
-                "prompt_language": config.get("TTS", "prompt_language", fallback="zh"),
-                "text_language": config.get("TTS", "text_language", fallback="zh"),
-                "enable_tts": config.get("TTS", "enable_tts", fallback="True"),
-            },
-        }
-        return self.config
+        with self.lock:
+            self.futures.append(segment.future)
+            self.waiting.append(segment)
+        self.segments.put_nowait(segment)
+        segment.future.add_done_callback(self._segment_done)
+        segment.future.add_done_callback(lambda _: segment.chunks.put_nowait(None))
+        self._schedule_waiting()
 
-    def save_config(self, config_data):
-        """保存配置文件"""
-        config = configparser.ConfigParser()
-        config["API"] = {
-            "ollama_url": config_data["API"]["ollama_url"],
-            "tts_url": config_data["API"]["tts_url"],
-            "default_model": config_data["API"]["default_model"],
-        }
-        config["TTS"] = {
-            "reference_wav": config_data["TTS"]["reference_wav"],
-            "prompt_text": config_data["TTS"]["prompt_text"],
-            "prompt_language": config_data["TTS"]["prompt_language"],
-            "text_language": config_data["TTS"]["text_language"],
-            "enable_tts": config_data["TTS"]["enable_tts"],
-        }
+    def _schedule_waiting(self):
+        """在并发数以内把等待中的句子交给调度器"""
+        while True:
+            with self.lock:
+                if self.cancelled or not self.waiting:
+                    return
+                if self.rejected is None and self.outstanding >= self.max_outstanding:
+                    return
+                segment = self.waiting.popleft()
+                if self.rejected is None:
+                    self.outstanding += 1
+            if self.rejected is not None:
+                segment.future.set_exception(self.rejected)
+                continue
 
-        with open(self.config_file, "w") as f:
-            config.write(f)
+            try:
+                ticket = get_scheduler("tts").enqueue(self.session_id, admitted=self.admitted)
+            except SchedulerFull as e:
+                with self.lock:
+                    self.outstanding -= 1
+                    self.rejected = e
+                segment.future.set_exception(e)
+                continue
+            self.admitted = True
+            task = asyncio.ensure_future(
+                async_scheduled_tts_service(ticket, segment.sentence, segment.on_chunk, self.voice)
+            )
+            with self.lock:
+                self.tickets.append(ticket)
+                self.tasks.append(task)
+            task.add_done_callback(lambda task, segment=segment: self._task_done(task, segment))
 
-        self.config = config_data
-        return True
+    def _task_done(self, task, segment):
+        """把合成结果交给句子，空出的名额留给下一个等待中的句子"""
+        with self.lock:
+            self.outstanding -= 1
+        if not segment.future.done():
+            if task.cancelled():
+                segment.future.cancel()
+            elif task.exception() is not None:
+                segment.future.set_exception(task.exception())
+            else:
+                segment.future.set_result(task.result())
+        self._schedule_waiting()
 
-    def check_config(self):
-        """检查必要配置是否完整"""
-        if not self.config:
-            return ["配置文件未加载"]
+    def queue_ticket(self):
+        """返回本轮第一个句子的调度名额，尚未提交句子时返回 None"""
+        with self.lock:
+            return self.tickets[0] if self.tickets else None
 
-        required_fields = [
-            ("API", "ollama_url", "Ollama API地址"),
-            ("API", "tts_url", "TTS服务地址"),
-            ("TTS", "reference_wav", "参考音频路径"),
-            ("TTS", "prompt_text", "参考文本"),
-        ]
+    def cancel(self):
+        """取消流水线：排队中的句子放弃名额，合成中的任务被中断，播放端立即结束（可从任意线程调用）"""
+        self.loop.call_soon_threadsafe(self._cancel)
 
-        missing = []
-        for section, key, name in required_fields:
-            if not self.config[section].get(key, "").strip():
-                missing.append(f"{name} ({section}.{key})")
+    def _cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            tickets = list(self.tickets)
+            futures = self.tasks + self.futures
+            self.waiting.clear()
+        for ticket in tickets:
+            ticket.release()
+        for future in futures:
+            future.cancel()
+        self.close()
 
-        return missing
+    def close(self):
+        """标记不再有新句子"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.segments.put_nowait(None)
+        self._check_complete()
 
-    def reset_audio_state(self):
-        """重置音频相关状态"""
-        self.audio_generated.clear()
-        self.audio_file_path = None
-        self.tts_error = None
-        self.tts_elapsed = None
-        self.audio_ready = False
+    def _segment_done(self, future):
+        with self.lock:
+            if future.cancelled():
+                self.errors.append("语音合成已取消")
+            elif future.exception() is not None:
+                self.errors.append(str(future.exception()))
+            elif future is self.futures[0] and self.first_audio_elapsed is None:
+                self.first_audio_elapsed = time.time() - self.start_time
+        self._check_complete()
 
+    def _check_complete(self):
+        with self.lock:
+            if not self.closed or self.done.is_set():
+                return
+            if not all(future.done() for future in self.futures):
+                return
+            self.elapsed = time.time() - self.start_time
+            self.done.set()
+        if self.on_complete:
+            self.on_complete(self)
 
-# 初始化应用状态
-app_state = AppState()
-app_state.load_config()
+    @staticmethod
+    def _segment_result(segment):
+        """返回片段的音频文件，失败或取消时返回 None"""
+        future = segment.future
+        if future.cancelled() or future.exception() is not None:
+            return None
+        audio_file, _ = future.result()
+        return audio_file
+
+    @staticmethod
+    def _read_unstreamed(joiner, segment, audio_file):
+        # 缓存命中或合并到其他请求时没有实时数据块，直接读取文件
+        if segment.streamed or not isinstance(audio_file, str):
+            return b""
+        with open(audio_file, "rb") as f:
+            return joiner.feed(f.read())
+
+    async def aiter_audio(self):
+        """按句子顺序产出音频，合成失败的片段会被跳过
+
+        stream_chunks 为 False 时产出音频文件路径，否则产出拼接好的WAV字节流。
+        """
+        joiner = WavStreamJoiner()
+        while True:
+            segment = await self.segments.get()
+            if segment is None or self.cancelled:
+                return
+
+            if not self.stream_chunks:
+                await asyncio.wait([segment.future])
+                audio_file = self._segment_result(segment)
+                if audio_file:
+                    yield audio_file
+                continue
+
+            joiner.start_segment()
+            while True:
+                chunk = await segment.chunks.get()
+                if chunk is None:
+                    break
+                data = joiner.feed(chunk)
+                if data:
+                    yield data
+            data = self._read_unstreamed(joiner, segment, self._segment_result(segment))
+            if data:
+                yield data
 
 # ======================
-# API 服务函数
+# 聊天处理函数
 # ======================
-def get_ollama_models():
-    """获取本地安装的Ollama模型列表"""
-    if not app_state.config or not app_state.config["API"].get("ollama_url"):
-        return ["qwen2.5vl:latest"]
+class TextRenderer:
+    """按帧预算渲染回复文本
 
-    try:
-        base_url = app_state.config["API"]["ollama_url"].replace("/api/generate", "")
-        models_url = f"{base_url}/api/tags"
-        response = requests.get(models_url, timeout=10)
-        response.raise_for_status()
-        models_data = response.json()
-        return [model["name"] for model in models_data.get("models", [])]
-    except Exception as e:
-        print(f"获取模型列表失败: {str(e)}")
-        return ["qwen2.5vl:latest", "llama3:latest", "mistral:latest"]
+    每帧最多刷新一次界面，输出的是本帧新增的片段而不是完整前缀。
+    完整文本按字速逐帧显示，总时长不超过 max_seconds；
+    实时生成的文本则把同一帧内到达的片段合并后一次输出。
+    """
 
-def generate_completion(prompt, model=None):
-    """生成文本回复"""
-    if not app_state.config or not app_state.config["API"].get("ollama_url"):
-        raise gr.Error("Ollama API地址未配置！请先完成配置")
+    def __init__(self, fps=25, chars_per_second=60, max_seconds=3.0):
+        self.frame_interval = 1.0 / max(1.0, fps)
+        self.chars_per_second = max(1.0, chars_per_second)
+        self.max_seconds = max(0.0, max_seconds)
 
-    if not model:
-        model = app_state.config["API"].get("default_model", "qwen2.5vl:latest")
+    @classmethod
+    def from_config(cls):
+        config = app_state.config or ConfigSnapshot({})
+        return cls(
+            fps=config.render_fps,
+            chars_per_second=config.render_chars_per_second,
+            max_seconds=config.render_max_seconds,
+        )
 
-    start_time = time.time()
-    url = app_state.config["API"]["ollama_url"]
-    headers = {"Content-Type": "application/json"}
-    data = {"model": model, "prompt": prompt, "stream": False}
+    def plan(self, text):
+        """把完整文本切分为逐帧显示的片段"""
+        duration = min(len(text) / self.chars_per_second, self.max_seconds)
+        frames = max(1, int(duration / self.frame_interval))
+        size = max(1, -(-len(text) // frames))
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def areveal(self, text):
+        """逐帧输出完整文本的片段"""
+        for i, delta in enumerate(self.plan(text)):
+            if i:
+                await asyncio.sleep(self.frame_interval)
+            yield delta
+
+    async def acoalesce(self, tokens):
+        """合并同一帧内到达的文本片段，每帧最多输出一次"""
+        pending = []
+        last_emit = 0.0
+        async for token in tokens:
+            pending.append(token)
+            now = time.time()
+            if now - last_emit >= self.frame_interval:
+                yield "".join(pending)
+                pending = []
+                last_emit = now
+        if pending:
+            yield "".join(pending)
+
+# 排队时刷新排队状态的间隔（秒）
+QUEUE_STATUS_INTERVAL = 0.5
 
+def enqueue_generation(turn):
+    """为本轮对话的文本生成排队，队列已满时直接拒绝"""
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=30)
-        response.raise_for_status()
-        elapsed = time.time() - start_time
-        
-        raw_response = response.json().get("response", "")
-        # 移除<think></think>标签及其内容
-        cleaned_response = re.sub(r'<think>.*?</think>', '', raw_response, flags=re.DOTALL)
-        
-        return cleaned_response, elapsed, model
-    except Exception as e:
-        raise gr.Error(f"生成回复时出错: {str(e)}")
+        return get_scheduler("llm").enqueue(turn.session_id)
+    except SchedulerFull as e:
+        raise gr.Error(str(e))
 
-def tts_service(text):
-    """调用TTS服务生成语音"""
-    if not app_state.config:
-        raise gr.Error("配置未加载，无法进行语音合成")
+def release_generation(turn):
+    """释放本轮对话的文本生成名额（可重复调用）"""
+    if turn.llm_ticket:
+        turn.llm_ticket.release()
 
-    missing = app_state.check_config()
-    if missing:
-        raise gr.Error(f"配置不完整，无法进行语音合成。缺少: {', '.join(missing)}")
+def start_audio_generation(turn, text):
+    """根据配置在后台启动语音生成"""
+    turn.audio_started = True
+    # 检查是否启用了语音生成
+    if not turn.config.enable_tts or turn.text_only:
+        turn.mark_audio_done()
+    elif turn.tts_pipeline:
+        # 分句流水线：提交尚未提交的句子
+        splitter = SentenceSplitter()
+        for sentence in splitter.feed(text) + splitter.flush():
+            turn.tts_pipeline.submit(sentence)
+        turn.tts_pipeline.close()
+    else:
+        turn.tts_task = asyncio.ensure_future(async_generate_audio(turn, text))
 
-    start_time = time.time()
-    tts_url = app_state.config["API"]["tts_url"]
+def get_audio_status(turn):
+    """返回当前语音状态提示和语音合成耗时"""
+    if not turn.config.enable_tts:
+        return "🔇 语音功能已禁用", ""
+    if turn.text_only:
+        return "🔇 语音服务暂不可用，本轮只回复文字", ""
 
-    try:
-        response = requests.get(
-            tts_url,
-            params={
-                "refer_wav_path": app_state.config["TTS"]["reference_wav"],
-                "prompt_text": app_state.config["TTS"]["prompt_text"],
-                "prompt_language": app_state.config["TTS"]["prompt_language"],
-                "text": text,
-                "text_language": app_state.config["TTS"]["text_language"],
-            },
-            timeout=300,
-        )
+    pipeline = turn.tts_pipeline
+    if not turn.audio_generated.is_set():
+        if pipeline and pipeline.first_audio_elapsed is not None:
+            return "🔊 语音播放中...", ""
+        # 第一段语音还在排队时显示位置和等待时间
+        ticket = pipeline.queue_ticket() if pipeline else turn.tts_ticket
+        if ticket and not ticket.settled.is_set():
+            return ticket.status_text("语音"), ""
+        return "⏳ 正在生成语音...", ""
+    if turn.tts_error:
+        return f"❌ 语音生成失败: {turn.tts_error}", ""
+    if turn.audio_file_path:
+        return "🔊 语音就绪", turn.tts_elapsed or ""
+    if pipeline:
+        return "🔊 语音就绪", turn.tts_elapsed or ""
+    return "", ""
 
-        response.raise_for_status()
-        elapsed = time.time() - start_time
+def get_final_text(turn, monica_response):
+    """在完整回复后附加语音失败信息"""
+    final_text = monica_response
+    if turn.config.enable_tts and not turn.text_only:
+        if turn.tts_error:
+            final_text += f"\n\n语音生成失败: {turn.tts_error}"
+        elif (
+            turn.audio_generated.is_set()
+            and not turn.audio_file_path
+            and not turn.tts_pipeline
+        ):
+            final_text += "\n\n语音生成失败: 未知错误"
+    return final_text
 
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        audio_file = f"output_audio_{timestamp}.wav"
-        with open(audio_file, "wb") as f:
-            f.write(response.content)
-        return audio_file, elapsed
-    except Exception as e:
-        raise gr.Error(f"语音合成失败: {str(e)}")
+class ReplyBuilder:
+    """累积流式回复：过滤思考内容，并把完整的句子送入语音合成流水线"""
+
+    def __init__(self, turn):
+        self.turn = turn
+        self.splitter = SentenceSplitter()
+        self.think_filter = ThinkFilter()
+        self.visible_text = ""
+        self.thinking_text = ""
+
+    def _append(self, visible, thinking):
+        self.thinking_text += thinking
+        if visible:
+            self.visible_text += visible
+            pipeline = self.turn.tts_pipeline
+            if pipeline:
+                for sentence in self.splitter.feed(visible):
+                    pipeline.submit(sentence)
+
+    def add(self, token):
+        """追加一个文本片段，返回当前可显示的文本"""
+        self._append(*self.think_filter.feed(token))
+        return self.visible_text
+
+    def finish(self):
+        """回复结束：提交剩余文本并启动（或结束）语音合成，返回完整回复"""
+        self._append(*self.think_filter.flush())
+        completion = self.visible_text
+        pipeline = self.turn.tts_pipeline
+        if pipeline:
+            for sentence in self.splitter.flush():
+                pipeline.submit(sentence)
+            pipeline.close()
+        else:
+            start_audio_generation(self.turn, completion)
+        return completion
+
+def get_stopped_outputs():
+    """停止后只更新语音状态，已显示的回复和耗时保持不变"""
+    keep = gr.update()
+    return keep, keep, "⏹ 已停止", keep, keep, keep, keep
+
+def stop_turn(session):
+    """停止本会话正在进行的对话，释放占用的后端资源"""
+    if session and session.turn:
+        session.turn.cancel()
+
+def warm_up_model(model, reload=True):
+    """在后台预加载所选模型，立即返回加载状态，加载完成后由状态栏的定期刷新更新
+
+    reload 为 False 时（页面打开）已加载的模型不再请求。
+    """
+    if not model or not use_model_warmup() or app_state.check_config():
+        return ""
+    warmer = get_model_warmer()
+    if reload or not warmer.is_ready(model):
+        warmer.warm(model)
+    return get_model_status(model)
+
+def get_model_status(model):
+    """模型加载状态及模型信息，未启用预加载时为空"""
+    if not model or not use_model_warmup() or app_state.check_config():
+        return ""
+    status = get_model_warmer().status_text(model)
+    info = get_model_registry().describe(model)
+    return f"{status}（{info}）" if info else status
+
+def refresh_model_list(model, force=False):
+    """等待后台刷新模型列表完成后更新下拉框"""
+    if not app_state.config or not app_state.config["API"].get("ollama_url"):
+        return gr.Dropdown()
+    registry = get_model_registry()
+    registry.refresh(force).wait()
+    return gr.Dropdown(choices=registry.names() or [model], value=model)
+
+def clear_conversation(session):
+    """清空本会话的对话历史，开始新对话"""
+    if session and session.conversation:
+        session.conversation.clear()
+    return session, "", ""
+
+def select_voice(voice, session):
+    """切换本会话使用的声音，从下一轮对话开始生效"""
+    session = session or SessionState()
+    if not app_state.config or not voice:
+        return session
+    profile = app_state.config.voices.get(voice)
+    if profile is None:
+        raise gr.Error(f"声音不存在: {voice}")
+    errors = profile.validate()
+    if errors:
+        raise gr.Error(f"声音 {voice} 不可用: {'；'.join(errors)}")
+    session.voice = voice
+    return session
+
+def refresh_voice_list(voice):
+    """更新声音下拉框，所选声音已被删除时改用默认声音"""
+    if not app_state.config:
+        return gr.Dropdown()
+    names = list(app_state.config.voices)
+    return gr.Dropdown(choices=names, value=voice if voice in names else app_state.config.default_voice)
+
+def save_voice_profile(name, ref_wav, p_text, p_lang, t_lang, make_default):
+    """新建或修改声音，设为默认时登记到TTS服务"""
+    name = name.strip()
+    if not app_state.config:
+        return "❌ 请先完成基本配置"
+    if not name:
+        return "❌ 请填写声音名称"
+    if name == DEFAULT_VOICE:
+        return f"❌ “{DEFAULT_VOICE}”声音请在上方的TTS设置中修改"
+    voice = VoiceProfile(name, ref_wav.strip(), p_text.strip(), p_lang, t_lang)
+    errors = voice.validate()
+    if errors:
+        return f"❌ {'；'.join(errors)}"
+
+    config_data = {VOICE_SECTION_PREFIX + name: voice.to_section()}
+    if make_default:
+        config_data["TTS"] = {"voice": name}
+    if not app_state.save_config(config_data):
+        return "❌ 配置保存失败"
+    if make_default:
+        return f"✅ 声音 {name} 已保存并设为默认，正在登记到TTS服务"
+    return f"✅ 声音 {name} 已保存"
+
+def delete_voice_profile(name):
+    """删除声音，删除的是默认声音时改回“默认”"""
+    name = name.strip()
+    if not app_state.config or name not in app_state.config.voices:
+        return f"❌ 声音不存在: {name}"
+    if name == DEFAULT_VOICE:
+        return f"❌ 不能删除“{DEFAULT_VOICE}”声音"
+    config_data = {VOICE_SECTION_PREFIX + name: None}
+    if app_state.config.default_voice == name:
+        config_data["TTS"] = {"voice": ""}
+    if not app_state.save_config(config_data):
+        return "❌ 配置保存失败"
+    return f"✅ 声音 {name} 已删除"
+
+def get_audio_component(session):
+    """只在音频就绪时返回音频组件"""
+    turn = session.turn
+    if turn.audio_file_path and not turn.tts_error:
+        return gr.Audio(value=turn.audio_file_path, autoplay=True, visible=True)
+    return gr.Audio(visible=False)
 
 # ======================
-# 聊天处理函数
+# 异步聊天处理函数
 # ======================
-def typewriter_effect(text, delay=0.03):
-    """实现打字机效果"""
-    for i in range(len(text) + 1):
-        yield text[:i]
-        time.sleep(delay)
-
-def generate_audio_in_thread(text):
-    """在后台线程中生成语音"""
+# 在Gradio的事件循环中运行，等待后端期间不占用工作线程，可同时处理大量对话。
+# 关闭异步后端时界面使用本节末尾的同步接口，由后台事件循环执行同样的流程。
+async def async_generate_audio(turn, text):
+    """在事件循环中生成语音"""
     try:
-        audio_file, elapsed = tts_service(text)
-        app_state.audio_file_path = audio_file
-        app_state.tts_elapsed = f"{elapsed:.2f}秒"
-        app_state.audio_generated.set()
-        return audio_file, elapsed
+        # 名额由 TurnState.cancel 取消本任务时在 finally 中释放
+        turn.tts_ticket = get_scheduler("tts").enqueue(turn.session_id)
+        try:
+            if not await turn.tts_ticket.wait_async():
+                raise TurnCancelled()
+            audio_file, elapsed = await async_tts_service(text, voice=turn.voice)
+        finally:
+            turn.tts_ticket.release()
+        turn.audio_file_path = audio_file
+        turn.tts_elapsed = f"{elapsed:.2f}秒"
+        METRIC_FIRST_AUDIO.observe(time.time() - turn.start_time)
     except Exception as e:
-        app_state.tts_error = str(e)
-        app_state.audio_generated.set()
-        return None, str(e)
+        turn.tts_error = str(e)
+    finally:
+        turn.mark_audio_done()
 
-def chat_with_monica(input_text, model):
+async def async_chat_with_monica(turn, input_text, model):
     """处理用户输入并生成Monica的回复"""
-    app_state.reset_audio_state()
-
-    missing = app_state.check_config()
+    missing = turn.config.missing
     if missing:
         raise gr.Error(f"配置不完整，无法聊天。缺少: {', '.join(missing)}")
 
-    # 生成文本回复
-    completion, gen_elapsed, used_model = generate_completion(input_text, model)
+    conversation = turn.conversation
+    history = conversation.history() if conversation else None
+    try:
+        completion, gen_elapsed, used_model = await turn.cancel_token.wait_for(
+            async_generate_completion(input_text, model, history)
+        )
+    finally:
+        release_generation(turn)
+    if conversation:
+        conversation.add_exchange(input_text, completion, used_model)
     monica_response = f"LocalTalk（使用 {used_model}）：{completion}"
-    time_log = [f"{gen_elapsed:.2f}秒"]
-
-    # 检查是否启用了语音生成
-    enable_tts = app_state.config["TTS"].get("enable_tts", "True").lower() == "true"
+    time_log = [f"{gen_elapsed:.2f}秒", f"{gen_elapsed:.2f}秒"]
 
-    if enable_tts:
-        threading.Thread(
-            target=generate_audio_in_thread, args=(completion,), daemon=True
-        ).start()
-    else:
-        app_state.audio_generated.set()
+    start_audio_generation(turn, completion)
 
     return monica_response, time_log
 
-def stream_response(monica_response, time_log, show):
+async def async_stream_response(turn, monica_response, time_log, show):
     """流式响应生成器，包含打字机效果和语音状态更新"""
     if monica_response is None:
-        yield "错误：未收到回复", "", ""
+        yield "错误：未收到回复", "", "", "", "", "", ""
         return
 
-    # 初始化时间显示
     gen_time_display = time_log[0] if show else ""
-    tts_time_display = ""
-    
-    # 应用打字机效果
-    for partial_text in typewriter_effect(monica_response):
-        # 检查语音状态
-        audio_status = ""
-        enable_tts = app_state.config["TTS"].get("enable_tts", "True").lower() == "true"
-
-        if enable_tts:
-            if app_state.audio_generated.is_set():
-                if app_state.audio_file_path:
-                    audio_status = "🔊 语音就绪"
-                    tts_time_display = app_state.tts_elapsed if app_state.tts_elapsed else ""
-                    if not app_state.audio_ready:
-                        app_state.audio_ready = True
-                elif app_state.tts_error:
-                    audio_status = f"❌ 语音生成失败: {app_state.tts_error}"
-            else:
-                audio_status = "⏳ 正在生成语音..."
+    ttft_display = time_log[1] if show else ""
+    cache_display = get_cache_stats() if show else ""
+
+    # 按帧逐段显示；对话记录只追加内容，Gradio 只需发送新增部分
+    shown_text = ""
+    audio_status = ""
+    async for delta in TextRenderer.from_config().areveal(monica_response):
+        turn.cancel_token.check()
+        shown_text += delta
+        audio_status, tts_time_display = get_audio_status(turn)
+        yield shown_text, "", audio_status, gen_time_display, ttft_display, tts_time_display, cache_display
+
+    # 播放器由 deliver_audio 单独更新，这里只在语音状态变化时刷新，结束后显示最终状态
+    while not await turn.wait_audio(QUEUE_STATUS_INTERVAL):
+        turn.cancel_token.check()
+        status, _ = get_audio_status(turn)
+        if status != audio_status:
+            audio_status = status
+            yield shown_text, "", audio_status, gen_time_display, ttft_display, "", cache_display
+    turn.cancel_token.check()
+
+    final_text = get_final_text(turn, monica_response)
+    audio_status, tts_time_display = get_audio_status(turn)
+    cache_display = get_cache_stats() if show else ""
+
+    yield final_text, "", audio_status, gen_time_display, ttft_display, tts_time_display, cache_display
+
+async def async_stream_chat_with_monica(turn, input_text, model, show):
+    """流式模式：边生成边显示回复，句子完整后即送入语音合成流水线"""
+    missing = turn.config.missing
+    if missing:
+        raise gr.Error(f"配置不完整，无法聊天。缺少: {', '.join(missing)}")
+
+    conversation = turn.conversation
+    history = conversation.history() if conversation else None
+    stream = CompletionStream(input_text, model, history, turn.cancel_token)
+    prefix = f"LocalTalk（使用 {stream.model}）："
+    reply = ReplyBuilder(turn)
+    ttft_display = ""
+    cache_display = get_cache_stats() if show else ""
+
+    audio_status = ""
+    async for chunk in TextRenderer.from_config().acoalesce(stream):
+        visible_text = reply.add(chunk)
+        if show and not ttft_display:
+            ttft_display = f"{stream.first_token_elapsed:.2f}秒"
+        # 已有句子送入流水线后显示语音排队情况
+        if turn.tts_pipeline and turn.tts_pipeline.queue_ticket():
+            audio_status, _ = get_audio_status(turn)
+        yield prefix + visible_text, reply.thinking_text, audio_status, "", ttft_display, "", cache_display
+
+    # 文本生成结束即释放名额，不必等待语音合成
+    release_generation(turn)
+    completion = reply.finish()
+    if conversation:
+        # 思考内容不计入历史，此时 eval_count 会高估回复的令牌数
+        reply_tokens = None if reply.thinking_text else stream.reply_tokens
+        conversation.add_exchange(input_text, completion, stream.model, reply_tokens)
+    monica_response = prefix + completion
+    gen_time_display = f"{stream.elapsed:.2f}秒" if show else ""
+    if show and stream.first_token_elapsed is None:
+        ttft_display = gen_time_display
+
+    audio_status, _ = get_audio_status(turn)
+    yield monica_response, reply.thinking_text, audio_status, gen_time_display, ttft_display, "", cache_display
+    while not await turn.wait_audio(QUEUE_STATUS_INTERVAL):
+        turn.cancel_token.check()
+        status, _ = get_audio_status(turn)
+        if status != audio_status:
+            audio_status = status
+            yield monica_response, reply.thinking_text, audio_status, gen_time_display, ttft_display, "", cache_display
+    turn.cancel_token.check()
+
+    audio_status, tts_time_display = get_audio_status(turn)
+    cache_display = get_cache_stats() if show else ""
+    yield (
+        get_final_text(turn, monica_response),
+        reply.thinking_text,
+        audio_status,
+        gen_time_display,
+        ttft_display,
+        tts_time_display,
+        cache_display,
+    )
+
+async def async_begin_turn(session):
+    """开始新一轮对话：为本会话新建请求状态并按需创建分句合成流水线（流水线绑定到当前事件循环）"""
+    if not app_state.config:
+        raise gr.Error("配置未加载，无法聊天")
+
+    session = session or SessionState()
+    turn = session.new_turn()
+    # 语音服务熔断时直接只回复文字，不必等待合成请求失败
+    turn.text_only = turn.config.enable_tts and not get_endpoint_pool("tts").available()
+    if turn.config.enable_tts and turn.config.pipeline_tts and not turn.text_only:
+        turn.tts_pipeline = TTSPipeline(
+            on_complete=turn.pipeline_finished,
+            stream_chunks=turn.config.tts_streaming,
+            session_id=turn.session_id,
+            voice=turn.voice,
+        )
+
+    # 隐藏上一轮的音频，分句模式下显示流式播放器
+    return (
+        session,
+        gr.Audio(value=None, visible=False),
+        gr.Audio(value=None, visible=turn.tts_pipeline is not None),
+    )
+
+async def async_respond(input_text, model, show, session):
+    """根据配置选择流式或非流式回复（需先调用 async_begin_turn）"""
+    if not app_state.config:
+        raise gr.Error("配置未加载，无法聊天")
+
+    turn = session.turn
+    enable_stream = turn.config.enable_stream
+    # 模型未加载或已超过 keep_alive 被卸载时，在排队的同时重新预加载
+    model = model or turn.config.default_model
+    if use_model_warmup() and not get_model_warmer().is_ready(model):
+        get_model_warmer().warm(model)
+    try:
+        turn.llm_ticket = enqueue_generation(turn)
+        # 排队期间显示位置和等待时间
+        while not await turn.llm_ticket.wait_async(QUEUE_STATUS_INTERVAL):
+            turn.cancel_token.check()
+            yield turn.llm_ticket.status_text(), "", "", "", "", "", ""
+
+        if enable_stream:
+            async for outputs in async_stream_chat_with_monica(turn, input_text, model, show):
+                yield outputs
         else:
-            audio_status = "🔇 语音功能已禁用"
+            monica_response, time_log = await async_chat_with_monica(turn, input_text, model)
+            async for outputs in async_stream_response(turn, monica_response, time_log, show):
+                yield outputs
+        METRIC_TURN_DURATION.observe(time.time() - turn.start_time)
+    except TurnCancelled:
+        # 被新消息打断时不再输出，以免覆盖新一轮的显示
+        if session.turn is turn:
+            yield get_stopped_outputs()
+    finally:
+        release_generation(turn)
+        # 生成失败时也要结束语音，避免音频播放端一直等待
+        if turn.tts_pipeline:
+            turn.tts_pipeline.close()
+        elif not turn.audio_started:
+            turn.mark_audio_done()
+
+async def async_stream_audio_segments(session):
+    """按顺序输出分句合成的音频片段，由流式播放器排队播放"""
+    pipeline = session.turn.tts_pipeline
+    if pipeline is None:
+        return
+    async for audio_file in pipeline.aiter_audio():
+        yield audio_file
 
-        # 更新显示文本
-        display_text = f"{partial_text}\n\n{audio_status}"
-        yield display_text, gen_time_display, tts_time_display
+async def async_deliver_audio(session):
+    """整段语音合成完成后立即显示播放器，与文本显示并行，不必等打字机效果结束"""
+    if session.turn.tts_pipeline:
+        # 分句模式由流式播放器输出
+        return gr.update()
+    await session.turn.wait_audio()
+    return get_audio_component(session)
 
-    # 最终显示状态
-    final_text = monica_response
-    if enable_tts:
-        if app_state.tts_error:
-            final_text += f"\n\n语音生成失败: {app_state.tts_error}"
-        elif app_state.audio_generated.is_set() and not app_state.audio_file_path:
-            final_text += "\n\n语音生成失败: 未知错误"
+# 同步接口：在后台事件循环中执行上面的流程，调用线程等待结果
+def begin_turn(session):
+    return run_sync(async_begin_turn(session))
 
-    # 确保语音合成时间已更新
-    if enable_tts and app_state.audio_generated.is_set() and app_state.audio_file_path and app_state.tts_elapsed:
-        tts_time_display = app_state.tts_elapsed
-    
-    yield final_text, gen_time_display, tts_time_display
+def respond(input_text, model, show, session):
+    yield from iterate_sync(async_respond(input_text, model, show, session))
 
-def get_audio_component():
-    """只在音频就绪时返回音频组件"""
-    if app_state.audio_ready and app_state.audio_file_path:
-        return gr.Audio(value=app_state.audio_file_path, autoplay=True, visible=True)
-    return gr.Audio(visible=False)
+def stream_audio_segments(session):
+    yield from iterate_sync(async_stream_audio_segments(session))
+
+def deliver_audio(session):
+    return run_sync(async_deliver_audio(session))
+
+# ======================
+# 配置热更新
+# ======================
+# 保存配置或修改 config.ini 后立即生效，无需重启：HTTP客户端、节点池和调度器按新快照就地更新，
+# 正在进行的对话继续使用开始时的快照。界面并发数和异步后端开关只在启动时读取。
+def apply_config_change(old, new):
+    """配置快照替换后更新后台组件"""
+    if old is None:
+        return
+    perf_changed = old.get("Performance") != new.get("Performance")
+    url_changed = old["API"].get("ollama_url") != new["API"].get("ollama_url")
+    if perf_changed:
+        # 连接池大小、超时等变化后重建HTTP客户端，节点池和缓存在下次使用时按新配置更新
+        reset_http_clients()
+        # 音频清理线程在后台运行，立即换用新的目录和上限
+        get_audio_store()
+    if perf_changed or old["TTS"] != new["TTS"]:
+        resize_schedulers()
+    if url_changed:
+        get_model_warmer().reset()
+        if new["API"].get("ollama_url"):
+            get_model_registry().refresh(force=True)
+    # 默认声音或TTS节点变化后重新登记
+    voice = new.get_voice()
+    if (
+        not new.missing
+        and new.enable_tts
+        and (
+            old.missing
+            or not old.enable_tts
+            or old.get_voice().reference_key != voice.reference_key
+            or old["API"].get("tts_url") != new["API"].get("tts_url")
+        )
+    ):
+        get_voice_registry().register_async(voice, force=True)
+    # 默认模型或节点变化、或配置刚补全时预加载默认模型
+    if (
+        not new.missing
+        and use_model_warmup()
+        and (url_changed or old.missing or old.default_model != new.default_model)
+    ):
+        get_model_warmer().warm(new.default_model)
+    print(f"配置已更新（版本 {new.version}）")
+
+app_state.add_listener(apply_config_change)
 
 # ======================
 # 界面创建函数
@@ -431,7 +3643,7 @@ def create_config_wizard():
             }
 
             if app_state.save_config(config_data):
-                return "✅ 配置保存成功！应用将在3秒后重启..."
+                return "✅ 配置保存成功，已立即生效！正在进入聊天界面..."
             else:
                 return "❌ 配置保存失败"
 
@@ -450,21 +3662,33 @@ def create_config_wizard():
             outputs=status,
         )
 
-        # 保存成功后重启应用
-        def restart_application(status_msg):
-            if status_msg.startswith("✅"):
-                time.sleep(3)
-                os.execl(sys.executable, sys.executable, *sys.argv)
-            return status_msg
-
-        status.change(fn=restart_application, inputs=status, outputs=status)
+        # 配置已在进程内生效，保存成功后刷新页面切换到聊天界面
+        status.change(
+            fn=None,
+            inputs=status,
+            js="(msg) => { if (msg.startsWith('✅')) { setTimeout(() => location.reload(), 1000); } }",
+        )
 
     return wizard
 
 def create_chat_interface():
     """创建聊天界面"""
-    model_list = get_ollama_models() if app_state.config else ["qwen2.5vl:latest"]
-    default_model = app_state.config["API"]["default_model"] if app_state.config else "qwen2.5vl:latest"
+    config = app_state.config or ConfigSnapshot({})
+    default_model = config.default_model
+    # 先用缓存的模型列表渲染，页面加载后再更新为最新列表
+    model_list = get_ollama_models() or [default_model]
+    voice_list = list(app_state.config.voices) if app_state.config else [DEFAULT_VOICE]
+    default_voice = app_state.config.default_voice if app_state.config else DEFAULT_VOICE
+    concurrency_limit = config.concurrency_limit
+    # 文本生成由调度器排队和拒绝，Gradio 只需容纳执行中和排队中的请求
+    respond_limit = max(concurrency_limit, config.llm_concurrency + config.llm_queue_size)
+    # 异步后端在事件循环中处理对话，不为每轮对话占用工作线程
+    if config.async_backend:
+        turn_fn, respond_fn = async_begin_turn, async_respond
+        audio_fn, segments_fn = async_deliver_audio, async_stream_audio_segments
+    else:
+        turn_fn, respond_fn = begin_turn, respond
+        audio_fn, segments_fn = deliver_audio, stream_audio_segments
 
     with gr.Blocks(title="LocalTalk") as chat_interface:
         # 显示配置状态
@@ -475,9 +3699,11 @@ def create_chat_interface():
             if missing:
                 return f"⚠️ **聊天功能不可用**，缺少必要配置: {', '.join(missing)}\n请前往'配置'页面进行设置"
             else:
-                enable_tts = app_state.config["TTS"].get("enable_tts", "True").lower() == "true"
-                tts_status = "启用" if enable_tts else "禁用"
-                return f"✅ **所有配置已设置**，可以开始聊天！\n语音功能: {tts_status}"
+                tts_status = "启用" if app_state.config.enable_tts else "禁用"
+                return (
+                    f"✅ **所有配置已设置**，可以开始聊天！\n语音功能: {tts_status}\n"
+                    + get_backend_status()
+                )
 
         config_status.value = update_config_status()
 
@@ -496,6 +3722,15 @@ def create_chat_interface():
                     value=default_model,
                     interactive=not bool(app_state.check_config()),
                 )
+                with gr.Row():
+                    model_status = gr.Markdown()
+                    refresh_models_btn = gr.Button("刷新模型", size="sm", scale=0)
+                voice_selector = gr.Dropdown(
+                    label="声音",
+                    choices=voice_list,
+                    value=default_voice,
+                    info="只影响本会话，从下一条消息开始生效",
+                )
 
                 user_input = gr.Textbox(
                     label="您的消息",
@@ -507,6 +3742,8 @@ def create_chat_interface():
                     submit_btn = gr.Button(
                         "发送", variant="primary", interactive=not bool(app_state.check_config())
                     )
+                    stop_btn = gr.Button("停止")
+                    clear_btn = gr.Button("新对话")
                     show_time = gr.Checkbox(label="显示耗时统计", value=True)
 
             with gr.Column():
@@ -516,12 +3753,30 @@ def create_chat_interface():
                     interactive=False,
                     elem_classes=["monica-chat"],
                 )
+                # 推理模型的思考过程，默认折叠
+                with gr.Accordion("思考过程", open=False):
+                    thinking_output = gr.Textbox(
+                        show_label=False,
+                        lines=6,
+                        interactive=False,
+                    )
+                voice_status = gr.Textbox(
+                    label="语音状态",
+                    interactive=False,
+                )
                 audio_output = gr.Audio(
                     label="LocalTalk的语音回复",
                     autoplay=True,
                     visible=False,
                     elem_classes=["monica-voice"],
                 )
+                segment_audio = gr.Audio(
+                    label="LocalTalk的语音回复",
+                    streaming=True,
+                    autoplay=True,
+                    visible=False,
+                    elem_classes=["monica-voice"],
+                )
 
             with gr.Row(visible=True) as time_row:
                 gen_time = gr.Textbox(
@@ -529,15 +3784,46 @@ def create_chat_interface():
                     interactive=False,
                     elem_classes=["time-stats"],
                 )
+                ttft_time = gr.Textbox(
+                    label="首字延迟",
+                    interactive=False,
+                    elem_classes=["time-stats"],
+                )
                 tts_time = gr.Textbox(
                     label="语音合成耗时",
                     interactive=False,
                     elem_classes=["time-stats"],
                 )
+                tts_cache_stats = gr.Textbox(
+                    label="缓存命中",
+                    interactive=False,
+                    elem_classes=["time-stats"],
+                )
+
+        # 每个浏览器会话独立的对话状态
+        session_state = gr.State()
+
+        # 页面加载时按最新配置更新状态提示和可用性，配置可能在启动后修改过
+        def update_chat_availability():
+            ready = not app_state.check_config()
+            return (
+                update_config_status(),
+                gr.update(interactive=ready),
+                gr.update(interactive=ready),
+                gr.update(interactive=ready),
+            )
 
-        # 用于存储中间状态
-        full_response = gr.State()
-        time_state = gr.State()
+        chat_interface.load(
+            fn=update_chat_availability,
+            outputs=[config_status, model_selector, user_input, submit_btn],
+        )
+        # 定期刷新状态栏和模型加载状态，后端熔断或恢复、模型加载完成后及时显示
+        def refresh_status(model):
+            return update_config_status(), get_model_status(model)
+
+        chat_interface.load(
+            fn=refresh_status, inputs=[model_selector], outputs=[config_status, model_status], every=5
+        )
 
         def toggle_time_visibility(show):
             return gr.Row.update(visible=show)
@@ -545,34 +3831,104 @@ def create_chat_interface():
         # 显示/隐藏耗时统计
         show_time.change(fn=toggle_time_visibility, inputs=show_time, outputs=time_row)
 
-        # 设置按钮点击事件
-        submit_btn.click(
-            fn=chat_with_monica,
-            inputs=[user_input, model_selector],
-            outputs=[full_response, time_state],
-        ).then(
-            fn=stream_response,
-            inputs=[full_response, time_state, show_time],
-            outputs=[chat_output, gen_time, tts_time],
-        ).then(
-            fn=get_audio_component,
-            inputs=[],
-            outputs=audio_output
+        # 设置按钮点击事件：文本与分句语音并行输出
+        submit_turn = submit_btn.click(
+            fn=turn_fn,
+            inputs=[session_state],
+            outputs=[session_state, audio_output, segment_audio],
+            concurrency_limit=concurrency_limit,
+        )
+        submit_turn.then(
+            fn=respond_fn,
+            inputs=[user_input, model_selector, show_time, session_state],
+            outputs=[chat_output, thinking_output, voice_status, gen_time, ttft_time, tts_time, tts_cache_stats],
+            concurrency_limit=respond_limit,
+        )
+        # 语音一合成完就推送到播放器，不等文本显示结束
+        submit_turn.then(
+            fn=audio_fn,
+            inputs=[session_state],
+            outputs=audio_output,
+            concurrency_limit=concurrency_limit,
+        )
+        submit_turn.then(
+            fn=segments_fn,
+            inputs=[session_state],
+            outputs=segment_audio,
+            concurrency_limit=concurrency_limit,
+        )
+
+        # 停止当前回复：中断上游请求并丢弃未播放的语音，不排队以便立即生效
+        stop_btn.click(fn=stop_turn, inputs=[session_state], queue=False)
+
+        # 切换模型时在后台预加载，页面打开时显示当前模型的加载状态
+        model_selector.change(
+            fn=warm_up_model,
+            inputs=[model_selector],
+            outputs=model_status,
+            concurrency_limit=concurrency_limit,
+        )
+        chat_interface.load(
+            fn=lambda model: warm_up_model(model, reload=False),
+            inputs=[model_selector],
+            outputs=model_status,
+            concurrency_limit=concurrency_limit,
+        )
+        chat_interface.load(
+            fn=refresh_model_list,
+            inputs=[model_selector],
+            outputs=model_selector,
+        )
+        refresh_models_btn.click(
+            fn=lambda model: refresh_model_list(model, force=True),
+            inputs=[model_selector],
+            outputs=model_selector,
+        )
+
+        # 切换本会话的声音
+        voice_selector.change(
+            fn=select_voice,
+            inputs=[voice_selector, session_state],
+            outputs=session_state,
+        )
+        chat_interface.load(
+            fn=refresh_voice_list,
+            inputs=[voice_selector],
+            outputs=voice_selector,
+        )
+
+        # 清空对话历史
+        clear_btn.click(
+            fn=clear_conversation,
+            inputs=[session_state],
+            outputs=[session_state, chat_output, thinking_output],
         )
 
         # 设置回车键提交
-        user_input.submit(
-            fn=chat_with_monica,
-            inputs=[user_input, model_selector],
-            outputs=[full_response, time_state],
-        ).then(
-            fn=stream_response,
-            inputs=[full_response, time_state, show_time],
-            outputs=[chat_output, gen_time, tts_time],
-        ).then(
-            fn=get_audio_component,
-            inputs=[],
-            outputs=audio_output
+        enter_turn = user_input.submit(
+            fn=turn_fn,
+            inputs=[session_state],
+            outputs=[session_state, audio_output, segment_audio],
+            concurrency_limit=concurrency_limit,
+        )
+        enter_turn.then(
+            fn=respond_fn,
+            inputs=[user_input, model_selector, show_time, session_state],
+            outputs=[chat_output, thinking_output, voice_status, gen_time, ttft_time, tts_time, tts_cache_stats],
+            concurrency_limit=respond_limit,
+        )
+        # 语音一合成完就推送到播放器，不等文本显示结束
+        enter_turn.then(
+            fn=audio_fn,
+            inputs=[session_state],
+            outputs=audio_output,
+            concurrency_limit=concurrency_limit,
+        )
+        enter_turn.then(
+            fn=segments_fn,
+            inputs=[session_state],
+            outputs=segment_audio,
+            concurrency_limit=concurrency_limit,
         )
 
     return chat_interface
@@ -584,10 +3940,7 @@ def create_config_editor():
         app_state.load_config()
     
     # 如果配置仍然为空，使用默认值
-    config = app_state.config or {
-        "API": {"ollama_url": "", "tts_url": "", "default_model": "qwen2.5vl:latest"},
-        "TTS": {"reference_wav": "", "prompt_text": "", "prompt_language": "zh", "text_language": "zh", "enable_tts": "True"}
-    }
+    config = app_state.config or ConfigSnapshot({"API": {}, "TTS": {}})
 
     with gr.Blocks(title="配置管理") as config_editor:
         gr.Markdown("## ⚙️ 系统配置管理")
@@ -599,14 +3952,23 @@ def create_config_editor():
             with gr.Column():
                 gr.Markdown("#### API 设置")
                 ollama_url = gr.Textbox(
-                    label="Ollama API地址", value=config["API"].get("ollama_url", "")
+                    label="Ollama API地址",
+                    value=config["API"].get("ollama_url", ""),
+                    info="多个节点用逗号分隔",
                 )
                 tts_url = gr.Textbox(
-                    label="TTS服务地址", value=config["API"].get("tts_url", "")
+                    label="TTS服务地址",
+                    value=config["API"].get("tts_url", ""),
+                    info="多个节点用逗号分隔",
                 )
                 default_model = gr.Textbox(
                     label="默认模型",
-                    value=config["API"].get("default_model", "qwen2.5vl:latest"),
+                    value=config.default_model,
+                )
+                enable_stream = gr.Checkbox(
+                    label="启用流式输出",
+                    value=config.enable_stream,
+                    info="边生成边显示回复，无需等待完整回复",
                 )
             with gr.Column():
                 gr.Markdown("#### TTS 设置")
@@ -631,7 +3993,7 @@ def create_config_editor():
                 # 添加语音生成开关
                 enable_tts = gr.Checkbox(
                     label="启用语音生成功能",
-                    value=config["TTS"].get("enable_tts", "True").lower() == "true",
+                    value=config.enable_tts,
                     info="如果禁用此选项，聊天时将不会生成语音",
                 )
 
@@ -639,11 +4001,46 @@ def create_config_editor():
         save_btn = gr.Button("💾 保存配置", variant="primary")
         status = gr.Textbox(label="保存状态", interactive=False)
 
+        with gr.Accordion("声音管理", open=False):
+            gr.Markdown(
+                "保存多组参考音频设置，聊天时可按会话切换。默认声音会登记到TTS服务，"
+                "合成请求只需发送文本，服务端不必每次重新处理参考音频。"
+            )
+            with gr.Row():
+                voice_name = gr.Textbox(label="声音名称")
+                voice_default = gr.Checkbox(label="设为默认声音")
+            with gr.Row():
+                voice_wav = gr.Textbox(label="参考音频路径")
+                voice_text = gr.Textbox(label="参考文本")
+            with gr.Row():
+                voice_prompt_lang = gr.Dropdown(
+                    label="参考文本语言", choices=["zh", "en", "jp"], value="zh"
+                )
+                voice_text_lang = gr.Dropdown(
+                    label="合成文本语言", choices=["zh", "en", "jp"], value="zh"
+                )
+            with gr.Row():
+                save_voice_btn = gr.Button("保存声音", variant="primary")
+                delete_voice_btn = gr.Button("删除声音")
+            voice_status = gr.Textbox(label="声音状态", interactive=False)
+
+        save_voice_btn.click(
+            save_voice_profile,
+            inputs=[voice_name, voice_wav, voice_text, voice_prompt_lang, voice_text_lang, voice_default],
+            outputs=voice_status,
+        )
+        delete_voice_btn.click(delete_voice_profile, inputs=voice_name, outputs=voice_status)
+
         def save_current_config(
-            ollama, tts, ref_wav, p_text, p_lang, t_lang, d_model, tts_enabled
+            ollama, tts, ref_wav, p_text, p_lang, t_lang, d_model, tts_enabled, stream_enabled
         ):
             config_data = {
-                "API": {"ollama_url": ollama, "tts_url": tts, "default_model": d_model},
+                "API": {
+                    "ollama_url": ollama,
+                    "tts_url": tts,
+                    "default_model": d_model,
+                    "enable_stream": str(stream_enabled),
+                },
                 "TTS": {
                     "reference_wav": ref_wav,
                     "prompt_text": p_text,
@@ -654,7 +4051,7 @@ def create_config_editor():
             }
 
             if app_state.save_config(config_data):
-                return "✅ 配置保存成功！"
+                return "✅ 配置保存成功，已立即生效！"
             else:
                 return "❌ 配置保存失败"
 
@@ -669,26 +4066,135 @@ def create_config_editor():
                 text_lang,
                 default_model,
                 enable_tts,
+                enable_stream,
             ],
             outputs=status,
         )
 
+        # 页面加载时显示最新配置，配置文件可能已在外部修改
+        def load_current_config():
+            config = app_state.config
+            if not config:
+                return [gr.update()] * 9
+            return (
+                config["API"].get("ollama_url", ""),
+                config["API"].get("tts_url", ""),
+                config["TTS"].get("reference_wav", ""),
+                config["TTS"].get("prompt_text", ""),
+                config["TTS"].get("prompt_language", "zh"),
+                config["TTS"].get("text_language", "zh"),
+                config.default_model,
+                config.enable_tts,
+                config.enable_stream,
+            )
+
+        config_editor.load(
+            fn=load_current_config,
+            outputs=[
+                ollama_url,
+                tts_url,
+                reference_wav,
+                prompt_text,
+                prompt_lang,
+                text_lang,
+                default_model,
+                enable_tts,
+                enable_stream,
+            ],
+        )
+
     return config_editor
 
 # ======================
 # 主应用入口
 # ======================
-def launch_application():
-    """启动应用程序"""
-    # 清理旧的音频文件
-    for file in os.listdir():
-        if file.startswith("output_audio_") and file.endswith(".wav"):
+def get_backend_status():
+    """各后端的熔断状态，显示在聊天页的状态栏"""
+    backends = [("ollama", "文本生成")]
+    if app_state.config.enable_tts:
+        backends.append(("tts", "语音合成"))
+    lines = [get_endpoint_pool(backend).status_text(label) for backend, label in backends]
+    if app_state.config.enable_tts and not get_endpoint_pool("tts").available():
+        lines.append("语音恢复前只回复文字")
+    return "\n".join(lines)
+
+def get_page_visibility():
+    """配置完整时显示聊天界面，否则显示初始配置向导"""
+    ready = not app_state.check_config()
+    return gr.update(visible=not ready), gr.update(visible=ready)
+
+class StartupTimer:
+    """记录启动各阶段的耗时，服务可用后打印汇总；后台任务各自完成时单独打印"""
+
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.phases = []  # (阶段名, 耗时)
+
+    @contextmanager
+    def phase(self, name):
+        phase_start = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - phase_start))
+
+    def record(self, name, elapsed):
+        self.phases.append((name, elapsed))
+
+    def run_in_background(self, name, task):
+        """在后台线程中执行启动任务，不阻塞界面启动"""
+        def run():
+            task_start = time.time()
             try:
-                os.remove(file)
-            except:
-                pass
+                task()
+            except Exception as e:
+                print(f"启动任务 {name} 失败: {str(e)}")
+                return
+            print(f"启动任务 {name} 完成（{time.time() - task_start:.2f}秒）")
+
+        threading.Thread(target=run, name=f"startup-{name}", daemon=True).start()
 
-    # 创建主应用界面
+    def report(self):
+        phases = "，".join(f"{name} {elapsed:.2f}秒" for name, elapsed in self.phases)
+        print(f"启动完成，共 {time.time() - self.start_time:.2f}秒（{phases}）")
+
+startup_timer = StartupTimer(STARTUP_BEGIN)
+
+def check_endpoints():
+    """检查各后端节点是否在线；多个节点时由节点池的健康检查线程负责"""
+    backends = ["ollama", "tts"] if app_state.config.enable_tts else ["ollama"]
+    for backend in backends:
+        if not get_endpoint_urls(backend):
+            continue
+        pool = get_endpoint_pool(backend)
+        if len(pool.endpoints) == 1 and not pool.check(pool.endpoints[0]):
+            print(f"{backend} 节点不可用: {pool.endpoints[0].last_error}")
+
+def start_background_tasks():
+    """启动时的耗时工作放到后台线程，界面无需等待"""
+    config = app_state.config
+    # 音频文件保存在专用目录，由后台线程按时间和大小清理
+    get_audio_store()
+    # 读取磁盘上的缓存索引，缓存文件较多时需要一些时间
+    startup_timer.run_in_background("读取缓存", lambda: (get_tts_cache(), get_response_cache()))
+    if config["API"].get("ollama_url"):
+        startup_timer.run_in_background("获取模型列表", lambda: get_model_registry().refresh().wait())
+    if config.missing:
+        return
+    startup_timer.run_in_background("检查节点", check_endpoints)
+    # 预加载默认模型，第一条消息无需等待模型加载
+    if use_model_warmup():
+        startup_timer.run_in_background(
+            "预加载模型", lambda: get_model_warmer().warm(config.default_model).wait()
+        )
+    # 把默认声音登记到TTS服务，之后的合成请求只需发送文本
+    if config.enable_tts:
+        startup_timer.run_in_background(
+            "登记声音", lambda: get_voice_registry().register(config.get_voice())
+        )
+
+def create_main_app():
+    """创建主应用界面"""
     with gr.Blocks(
         theme=gr.themes.Soft(),
         css="""
@@ -697,13 +4203,13 @@ def launch_application():
         .monica-voice {max-height: 100px !important}
         """,
     ) as main_app:
-        # 根据是否首次运行显示不同界面
-        if app_state.first_run or not app_state.config or app_state.check_config():
+        # 两套界面都创建，页面加载时按当前配置是否完整显示其中一套，配置补全后刷新页面即可进入聊天
+        with gr.Column(visible=bool(app_state.check_config())) as wizard_page:
             gr.Markdown("# 🚀 欢迎使用LocalTalk")
             with gr.Tabs():
                 with gr.TabItem("初始配置", id="wizard"):
                     wizard = create_config_wizard()
-        else:
+        with gr.Column(visible=not app_state.check_config()) as chat_page:
             gr.Markdown("# 💬 LocalTalk")
             with gr.Tabs():
                 with gr.TabItem("聊天", id="chat"):
@@ -711,15 +4217,48 @@ def launch_application():
                 with gr.TabItem("配置管理", id="config"):
                     config_editor = create_config_editor()
 
+        main_app.load(fn=get_page_visibility, outputs=[wizard_page, chat_page])
+    return main_app
+
+def launch_application():
+    """启动应用程序：慢的工作放到后台，界面创建完成后立即开始服务"""
+    app_state.load_config()
+    startup_timer.record("加载模块和配置", time.time() - STARTUP_BEGIN)
+    if app_state.config is None and os.path.exists(app_state.config_file):
+        # 配置有无效的值时不进入初始配置向导，以免覆盖用户的配置文件
+        raise SystemExit(f"配置文件 {app_state.config_file} 无效，请修改后重新启动")
+    # 先启动后台任务，与导入Gradio、创建界面同时进行
+    if app_state.config:
+        start_background_tasks()
+
+    # 配置文件被外部修改后自动重新加载
+    config = app_state.config or ConfigSnapshot({})
+    app_state.watch(config.config_watch_interval)
+
+    with startup_timer.phase("导入Gradio"):
+        importlib.import_module("gradio")
+    with startup_timer.phase("创建界面"):
+        main_app = create_main_app()
+
+    # Prometheus 指标与界面使用同一端口
+    routes = []
+    if config.enable_metrics:
+        routes.append(Route("/metrics", metrics_endpoint))
+
     # 启动应用
-    main_app.launch(
-        server_name="0.0.0.0",
-        server_port=9976,
-        share=False,
-        inbrowser=False,
-        show_error=True,
-        pwa=True,
-    )
+    with startup_timer.phase("启动服务"):
+        main_app.launch(
+            server_name="0.0.0.0",
+            server_port=9976,
+            share=False,
+            inbrowser=False,
+            show_error=True,
+            pwa=True,
+            app_kwargs={"routes": routes},
+            prevent_thread_lock=True,
+        )
+    startup_timer.report()
+    main_app.block_thread()
 
 # 主程序入口
 if __name__ == "__main__":
@@ -0,0 +1,456 @@
+"""LocalTalk 性能基准测试
+
+启动模拟的 Ollama 和 GPT-SoVITS 服务，用 N 个并发用户驱动 aic_tts2.py 的聊天流程，
+统计吞吐量和各阶段延迟的分位数，无需真实的模型和显卡即可对比改动前后的性能。
+
+用法示例：
+    python benchmark.py --users 8 --turns 5
+    python benchmark.py --users 32 --async-backend --token-rate 50 --tts-rtf 0.3
+    python benchmark.py --dead-node    # 每个后端多配一个不可用的节点，检查故障转移和熔断
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# ======================
+# 模拟服务
+# ======================
+# 模拟回复的文本片段，带句末标点以触发分句合成
+REPLY_TOKENS = ["你好", "，", "我是", "本地", "助手", "。", "今天", "天气", "不错", "！", "有什么", "可以", "帮你", "的吗", "？"]
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """模拟Ollama的 /api/generate、/api/chat 和 /api/tags 接口"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, data):
+        line = (json.dumps(data) + "\n").encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/api/tags":
+            self.send_error(404)
+            return
+        self._send_json({
+            "models": [{
+                "name": self.server.options.model,
+                "size": 4 * 1024 ** 3,
+                "details": {"family": "mock", "parameter_size": "7B", "quantization_level": "Q4_K_M"},
+            }]
+        })
+
+    def do_POST(self):
+        options = self.server.options
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        is_chat = urlparse(self.path).path == "/api/chat"
+
+        def payload(text, done, **extra):
+            data = {"model": request.get("model"), "done": done, **extra}
+            if is_chat:
+                data["message"] = {"role": "assistant", "content": text}
+            else:
+                data["response"] = text
+            return data
+
+        # 不带 prompt 的请求用于加载模型
+        if not is_chat and not request.get("prompt"):
+            self._send_json(payload("", True, done_reason="load"))
+            return
+
+        tokens = [REPLY_TOKENS[i % len(REPLY_TOKENS)] for i in range(options.tokens)]
+        token_interval = 1.0 / options.token_rate
+        stats = {"eval_count": len(tokens), "eval_duration": int(len(tokens) * token_interval * 1e9)}
+        time.sleep(options.llm_latency)
+
+        if not request.get("stream", True):
+            time.sleep(token_interval * len(tokens))
+            self._send_json(payload("".join(tokens), True, **stats))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in tokens:
+            time.sleep(token_interval)
+            self._send_chunk(payload(token, False))
+        self._send_chunk(payload("", True, **stats))
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def make_wav(seconds, sample_rate):
+    """生成指定时长的静音WAV"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(b"\0\0" * int(seconds * sample_rate))
+    return buffer.getvalue()
+
+
+class MockTTSHandler(BaseHTTPRequestHandler):
+    """模拟GPT-SoVITS的合成接口：音频时长与文本长度成正比，合成耗时由实时率决定
+
+    请求带参考音频时额外等待 reference_latency，模拟每次提取参考音频特征；
+    /change_refer 设置默认参考音频后，只带文本的请求使用默认参考音频。
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        options = self.server.options
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path == "/change_refer":
+            if not params.get("refer_wav_path"):
+                self.send_error(400, "refer_wav_path is required")
+                return
+            time.sleep(options.reference_latency)
+            self.server.default_reference = params["refer_wav_path"][0]
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        text = params.get("text", [""])[0]
+        if not text:
+            self.send_error(400, "text is required")
+            return
+        if params.get("refer_wav_path"):
+            time.sleep(options.reference_latency)
+        elif not getattr(self.server, "default_reference", None):
+            self.send_error(400, "no reference audio")
+            return
+
+        seconds = len(text) * options.audio_seconds_per_char
+        audio = make_wav(seconds, options.sample_rate)
+        chunk_count = 4
+        chunk_size = -(-len(audio) // chunk_count)
+        time.sleep(options.tts_latency)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(audio)))
+        self.end_headers()
+        # 分块发送，模拟边合成边返回
+        for i in range(0, len(audio), chunk_size):
+            time.sleep(seconds * options.tts_rtf / chunk_count)
+            self.wfile.write(audio[i:i + chunk_size])
+            self.wfile.flush()
+
+
+def start_server(handler, options):
+    """在后台线程中启动模拟服务，返回服务对象"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.options = options
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def reserve_dead_port():
+    """占用一个端口但不监听，连接该端口会立即被拒绝，模拟宕机的节点
+
+    返回 (端口, socket)，测试期间保留 socket，以免端口被其他程序使用。
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1], sock
+
+
+# ======================
+# 测试驱动
+# ======================
+def write_config(options, ollama_port, tts_port, dead_port=None):
+    """在当前目录写入指向模拟服务的配置文件，dead_port 不为空时把不可用的节点排在每个后端的最前面"""
+    ollama_urls = [f"http://127.0.0.1:{ollama_port}/api/generate"]
+    tts_urls = [f"http://127.0.0.1:{tts_port}"]
+    if dead_port:
+        ollama_urls.insert(0, f"http://127.0.0.1:{dead_port}/api/generate")
+        tts_urls.insert(0, f"http://127.0.0.1:{dead_port}")
+
+    reference_wav = os.path.abspath("reference.wav")
+    with open(reference_wav, "wb") as f:
+        f.write(make_wav(1, options.sample_rate))
+
+    concurrency = str(max(16, options.users * 2))
+    with open("config.ini", "w", encoding="utf-8") as f:
+        f.write(f"""[API]
+ollama_url = {", ".join(ollama_urls)}
+tts_url = {", ".join(tts_urls)}
+default_model = {options.model}
+enable_stream = {not options.no_stream}
+
+[TTS]
+reference_wav = {reference_wav}
+prompt_text = 参考文本
+prompt_language = zh
+text_language = zh
+enable_tts = {not options.no_tts}
+pipeline_tts = {not options.no_pipeline}
+tts_concurrency = {options.tts_concurrency}
+tts_streaming = {options.tts_streaming}
+
+[Performance]
+concurrency_limit = {concurrency}
+async_backend = {options.async_backend}
+ollama_pool_size = {concurrency}
+tts_pool_size = {concurrency}
+llm_concurrency = {options.llm_concurrency}
+llm_queue_size = {options.users * options.turns}
+tts_queue_size = {options.users * options.turns * options.tokens}
+tts_cache = {options.tts_cache}
+warmup_models = False
+
+[Chat]
+enable_history = {options.history}
+""")
+
+
+class TurnTimer:
+    """记录一轮对话中各阶段首次出现的时间"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.first_text = None
+        self.text_done = None
+        self.first_audio = None
+        self.done = None
+        self.error = None
+
+    def on_text(self, outputs):
+        text, gen_time = outputs[0], outputs[3]
+        now = time.time() - self.start
+        # 排队提示不算回复内容
+        if self.first_text is None and text and not text.startswith("⏳"):
+            self.first_text = now
+        # 文本生成耗时出现时回复文本已完整，之后只是等待语音
+        if self.text_done is None and gen_time:
+            self.text_done = now
+
+    def on_audio(self):
+        if self.first_audio is None:
+            self.first_audio = time.time() - self.start
+
+
+def run_turn_sync(app, session, text, model):
+    """同步后端：文本和分句音频在两个线程中并行消费，与界面的两个分支相同"""
+    timer = TurnTimer()
+    session, _, _ = app.begin_turn(session)
+
+    def consume_audio():
+        for _ in app.stream_audio_segments(session):
+            timer.on_audio()
+
+    audio_thread = threading.Thread(target=consume_audio)
+    audio_thread.start()
+    try:
+        for outputs in app.respond(text, model, True, session):
+            timer.on_text(outputs)
+    except Exception as e:
+        timer.error = str(e)
+    audio_thread.join()
+    if session.turn.audio_file_path:
+        timer.on_audio()
+    timer.done = time.time() - timer.start
+    return session, timer
+
+
+async def run_turn_async(app, session, text, model):
+    """异步后端：在同一个事件循环中并行消费文本和分句音频"""
+    timer = TurnTimer()
+    session, _, _ = await app.async_begin_turn(session)
+
+    async def consume_text():
+        try:
+            async for outputs in app.async_respond(text, model, True, session):
+                timer.on_text(outputs)
+        except Exception as e:
+            timer.error = str(e)
+
+    async def consume_audio():
+        async for _ in app.async_stream_audio_segments(session):
+            timer.on_audio()
+
+    await asyncio.gather(consume_text(), consume_audio())
+    if session.turn.audio_file_path:
+        timer.on_audio()
+    timer.done = time.time() - timer.start
+    return session, timer
+
+
+def run_benchmark(app, options):
+    """N 个用户各自连续发送 turns 条消息，返回所有轮次的计时"""
+    model = options.model
+    timers = []
+    lock = threading.Lock()
+
+    if options.async_backend:
+        async def user(index):
+            session = None
+            for turn in range(options.turns):
+                session, timer = await run_turn_async(app, session, f"用户{index}的第{turn}条消息", model)
+                timers.append(timer)
+
+        async def main():
+            await asyncio.gather(*(user(i) for i in range(options.users)))
+
+        asyncio.run(main())
+        return timers
+
+    def user(index):
+        session = None
+        for turn in range(options.turns):
+            session, timer = run_turn_sync(app, session, f"用户{index}的第{turn}条消息", model)
+            with lock:
+                timers.append(timer)
+
+    threads = [threading.Thread(target=user, args=(i,)) for i in range(options.users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timers
+
+
+# ======================
+# 结果统计
+# ======================
+def percentile(values, p):
+    """最近秩法计算分位数"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def pad(text, width):
+    """按显示宽度左对齐（中文字符占两列）"""
+    display_width = sum(2 if ord(ch) > 127 else 1 for ch in text)
+    return text + " " * max(0, width - display_width)
+
+
+def report(timers, wall_time):
+    completed = [timer for timer in timers if not timer.error]
+    failed = len(timers) - len(completed)
+    print(f"\n轮次: {len(timers)}  失败: {failed}  总耗时: {wall_time:.2f}秒  "
+          f"吞吐量: {len(completed) / wall_time:.2f} 轮/秒")
+    if failed:
+        errors = sorted({timer.error for timer in timers if timer.error})
+        print("失败原因: " + "; ".join(errors[:3]))
+
+    rows = [
+        ("首字延迟", [t.first_text for t in completed]),
+        ("文本完成", [t.text_done for t in completed]),
+        ("首段语音", [t.first_audio for t in completed]),
+        ("端到端", [t.done for t in completed]),
+    ]
+    print("\n" + pad("阶段", 10) + pad("样本", 6) + "".join(f"{name:>10}" for name in ("p50", "p95", "p99", "max")))
+    for name, values in rows:
+        values = [value for value in values if value is not None]
+        if not values:
+            print(pad(name, 10) + f"{0:<6}")
+            continue
+        print(
+            pad(name, 10) + f"{len(values):<6}"
+            + "".join(f"{percentile(values, p):>10.3f}" for p in (50, 95, 99))
+            + f"{max(values):>10.3f}"
+        )
+
+
+def report_endpoints(app):
+    """各后端节点的熔断状态：不可用的节点应已暂停使用，请求全部由正常的节点完成"""
+    print()
+    for backend, label in (("ollama", "文本生成"), ("tts", "语音合成")):
+        pool = app.get_endpoint_pool(backend)
+        print(pool.status_text(label))
+        for endpoint in pool.endpoints:
+            state = "暂停使用" if endpoint.circuit_open else ("正常" if endpoint.healthy else "异常")
+            print(f"  {endpoint.url}  {state}  连续失败 {endpoint.failures} 次")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="LocalTalk 性能基准测试（使用模拟的Ollama和GPT-SoVITS服务）")
+    parser.add_argument("--users", type=int, default=4, help="并发用户数")
+    parser.add_argument("--turns", type=int, default=3, help="每个用户发送的消息数")
+    parser.add_argument("--model", default="mock:latest", help="模拟的模型名")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="模拟的首字前延迟（秒）")
+    parser.add_argument("--token-rate", type=float, default=40, help="模拟的生成速度（片段/秒）")
+    parser.add_argument("--tokens", type=int, default=30, help="每条回复的片段数")
+    parser.add_argument("--tts-latency", type=float, default=0.1, help="模拟的语音合成固定延迟（秒）")
+    parser.add_argument("--reference-latency", type=float, default=0.05, help="模拟的参考音频处理耗时（秒）")
+    parser.add_argument("--tts-rtf", type=float, default=0.2, help="模拟的语音合成实时率")
+    parser.add_argument("--audio-seconds-per-char", type=float, default=0.2, help="每个字的音频时长（秒）")
+    parser.add_argument("--sample-rate", type=int, default=32000, help="模拟音频的采样率")
+    parser.add_argument("--async-backend", action="store_true", help="使用异步后端")
+    parser.add_argument("--no-stream", action="store_true", help="关闭流式输出")
+    parser.add_argument("--no-tts", action="store_true", help="关闭语音合成")
+    parser.add_argument("--no-pipeline", action="store_true", help="关闭分句合成流水线")
+    parser.add_argument("--tts-streaming", action="store_true", help="启用流式语音合成")
+    parser.add_argument("--tts-cache", action="store_true", help="启用语音缓存（默认关闭以测量真实合成）")
+    parser.add_argument("--history", action="store_true", help="启用多轮对话历史")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="文本生成并发上限")
+    parser.add_argument("--tts-concurrency", type=int, default=2, help="语音合成并发上限")
+    parser.add_argument("--dead-node", action="store_true", help="每个后端多配一个不可用的节点，测试故障转移和熔断")
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    ollama = start_server(MockOllamaHandler, options)
+    tts = start_server(MockTTSHandler, options)
+
+    # 在临时目录中运行，配置文件、音频和缓存都不影响当前目录
+    workdir = tempfile.mkdtemp(prefix="localtalk-bench-")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    dead_port, dead_socket = reserve_dead_port() if options.dead_node else (None, None)
+    write_config(options, ollama.server_address[1], tts.server_address[1], dead_port)
+
+    import aic_tts2 as app
+    app.app_state.load_config()
+    # 网页端启动时已导入Gradio，提前导入以免第一轮的耗时包含导入时间
+    import gradio
+
+    mode = "异步" if options.async_backend else "同步"
+    print(f"{mode}后端，{options.users} 个用户 × {options.turns} 轮，工作目录 {workdir}")
+    start_time = time.time()
+    timers = run_benchmark(app, options)
+    report(timers, time.time() - start_time)
+    if options.dead_node:
+        report_endpoints(app)
+        dead_socket.close()
+
+    ollama.shutdown()
+    tts.shutdown()
+
+
+if __name__ == "__main__":
+    main()
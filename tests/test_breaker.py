@@ -0,0 +1,215 @@
+"""节点熔断的状态转换测试
+
+用本地的模拟TTS服务代替真实节点：服务返回 503 时节点检测失败，返回 400 时视为在线
+（与 GPT-SoVITS 对不带参数的请求返回参数错误相同）。
+
+运行：python -m pytest tests 或 python -m unittest discover tests
+"""
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aic_tts2 as app  # noqa: E402
+
+PROBE_INTERVAL = 0.05
+
+
+class MockTTSHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(self.server.status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def start_server(status):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockTTSHandler)
+    server.daemon_threads = True
+    server.status = status
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def connect_error():
+    return httpx.ConnectError("Connection refused")
+
+
+class BreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.server, self.url = start_server(503)
+        app.app_state._apply({
+            "API": {"tts_url": self.url},
+            "TTS": {"enable_tts": "True"},
+            "Performance": {
+                "breaker_failures": "2",
+                "breaker_probe_interval": str(PROBE_INTERVAL),
+                "health_check_interval": "60",
+            },
+        })
+
+    def tearDown(self):
+        with app._endpoint_pools_lock:
+            for pool in app._endpoint_pools.values():
+                pool.stop()
+            app._endpoint_pools.clear()
+        stop_server(self.server)
+
+    def test_opens_after_consecutive_failures(self):
+        """连续失败达到 breaker_failures 次才熔断，中间成功一次则重新计数"""
+        pool = app.get_endpoint_pool("tts")
+        endpoint = pool.endpoints[0]
+
+        self.assertTrue(pool.handle_failure(endpoint, connect_error()))
+        self.assertFalse(endpoint.circuit_open)
+        pool.mark_ok(endpoint)
+        pool.handle_failure(endpoint, connect_error())
+        self.assertFalse(endpoint.circuit_open)
+        self.assertTrue(pool.available())
+
+        pool.handle_failure(endpoint, connect_error())
+        self.assertTrue(endpoint.circuit_open)
+        self.assertFalse(pool.available())
+        self.assertEqual(pool.candidates(), [])
+        error = pool.unavailable_error()
+        self.assertIsInstance(error, app.BackendUnavailable)
+        self.assertIn("Connection refused", str(error))
+
+    def test_probe_keeps_circuit_open_while_node_is_down(self):
+        """熔断后由探测线程检查节点，节点仍不可用时保持熔断"""
+        pool = app.get_endpoint_pool("tts")
+        endpoint = pool.endpoints[0]
+        for _ in range(2):
+            pool.handle_failure(endpoint, connect_error())
+
+        self.assertTrue(endpoint.probing)
+        failures = endpoint.failures
+        self.assertTrue(wait_until(lambda: endpoint.failures > failures))
+        self.assertTrue(endpoint.circuit_open)
+        self.assertTrue(endpoint.probing)
+
+    def test_probe_closes_circuit_after_recovery(self):
+        """节点恢复后探测成功（半开），熔断关闭，探测线程结束"""
+        pool = app.get_endpoint_pool("tts")
+        endpoint = pool.endpoints[0]
+        for _ in range(2):
+            pool.handle_failure(endpoint, connect_error())
+
+        self.server.status = 400
+        self.assertTrue(wait_until(lambda: not endpoint.circuit_open))
+        self.assertTrue(wait_until(lambda: not endpoint.probing))
+        self.assertTrue(endpoint.healthy)
+        self.assertEqual(endpoint.failures, 0)
+        self.assertIsNone(endpoint.last_error)
+        self.assertEqual(pool.candidates(), [endpoint])
+
+    def test_probe_stops_when_pool_is_rebuilt(self):
+        """节点地址变化后重建节点池，旧节点池的探测线程随之结束"""
+        pool = app.get_endpoint_pool("tts")
+        endpoint = pool.endpoints[0]
+        for _ in range(2):
+            pool.handle_failure(endpoint, connect_error())
+        self.assertTrue(endpoint.probing)
+
+        other, other_url = start_server(400)
+        try:
+            sections = {name: dict(values) for name, values in app.app_state.config.items()}
+            sections["API"]["tts_url"] = other_url
+            app.app_state._apply(sections)
+            new_pool = app.get_endpoint_pool("tts")
+            self.assertIsNot(new_pool, pool)
+            self.assertTrue(wait_until(lambda: not endpoint.probing))
+            # 旧节点池停止后不再检查节点
+            self.assertTrue(endpoint.circuit_open)
+            self.assertTrue(new_pool.available())
+        finally:
+            stop_server(other)
+
+    def test_single_node_banner_uses_probe_interval(self):
+        """单个节点没有健康检查，提示探测间隔"""
+        pool = app.get_endpoint_pool("tts")
+        for _ in range(2):
+            pool.handle_failure(pool.endpoints[0], connect_error())
+        self.assertEqual(
+            pool.status_text("语音合成"), f"🔴 语音合成服务不可用，已暂停请求，每 {PROBE_INTERVAL:g}秒自动检测恢复"
+        )
+        self.assertIn(f"每 {PROBE_INTERVAL:g}秒", str(pool.unavailable_error()))
+
+    def test_probe_interval_must_be_positive(self):
+        """breaker_probe_interval 为 0 会让探测线程空转，配置无效"""
+        sections = {name: dict(values) for name, values in app.app_state.config.items()}
+        sections["Performance"]["breaker_probe_interval"] = "0"
+        with self.assertRaisesRegex(ValueError, "breaker_probe_interval"):
+            app.ConfigSnapshot(sections)
+
+    def test_health_check_disabled_uses_probe(self):
+        """health_check_interval 为 0 时多个节点也不启动健康检查，熔断的节点由探测线程恢复"""
+        other, other_url = start_server(400)
+        try:
+            sections = {name: dict(values) for name, values in app.app_state.config.items()}
+            sections["API"]["tts_url"] = f"{self.url}, {other_url}"
+            sections["Performance"]["health_check_interval"] = "0"
+            app.app_state._apply(sections)
+            pool = app.get_endpoint_pool("tts")
+            self.assertIsNone(pool._thread)
+            first = pool.endpoints[0]
+
+            for _ in range(2):
+                pool.handle_failure(first, connect_error())
+            self.assertTrue(first.probing)
+            self.server.status = 400
+            self.assertTrue(wait_until(lambda: not first.circuit_open))
+        finally:
+            stop_server(other)
+
+    def test_banner_text(self):
+        """状态栏在正常、部分节点熔断和全部熔断时的提示"""
+        other, other_url = start_server(400)
+        try:
+            sections = {name: dict(values) for name, values in app.app_state.config.items()}
+            sections["API"]["tts_url"] = f"{self.url}, {other_url}"
+            app.app_state._apply(sections)
+            pool = app.get_endpoint_pool("tts")
+            first, second = pool.endpoints
+
+            self.assertEqual(pool.status_text("语音合成"), "🟢 语音合成正常")
+            pool.mark_ok(second, elapsed=0.5)
+            self.assertEqual(pool.status_text("语音合成"), "🟢 语音合成正常（平均响应 0.50秒）")
+
+            for _ in range(2):
+                pool.handle_failure(first, connect_error())
+            self.assertEqual(pool.status_text("语音合成"), "🟡 语音合成：1/2 个节点暂停使用（平均响应 0.50秒）")
+
+            for _ in range(2):
+                pool.handle_failure(second, connect_error())
+            # 多个节点时由健康检查线程负责恢复，提示健康检查的间隔
+            banner = app.get_backend_status().splitlines()
+            self.assertEqual(banner[1], "🔴 语音合成服务不可用，已暂停请求，每 60秒自动检测恢复")
+            self.assertEqual(banner[2], "语音恢复前只回复文字")
+        finally:
+            stop_server(other)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+"""配置文件读写的测试
+
+运行：python -m pytest tests 或 python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aic_tts2 as app  # noqa: E402
+
+BASIC_CONFIG = {
+    "API": {"ollama_url": "http://127.0.0.1:11434", "tts_url": "http://127.0.0.1:9880"},
+    "TTS": {"reference_wav": "ref.wav", "prompt_text": "参考文本"},
+}
+
+
+class ConfigFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.state = app.AppState()
+        self.state.config_file = os.path.join(self.dir.name, "config.ini")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_defaults_come_from_field_definitions(self):
+        """只写了必要配置时，读取结果包含所有配置项的默认值"""
+        with open(self.state.config_file, "w") as f:
+            f.write("[API]\ndefault_model = llama3\n")
+        config = self.state.load_config()
+        for section, key, default in app.ConfigSnapshot.fields():
+            if key != "default_model":
+                self.assertEqual(config[section][key], default, f"{section}.{key}")
+        self.assertEqual(config["API"]["default_model"], "llama3")
+        self.assertEqual(config.health_check_interval, 15)
+
+    def test_save_replaces_file_and_records_mtime(self):
+        """保存后没有遗留临时文件，重新加载后记下的修改时间与文件一致"""
+        self.assertTrue(self.state.save_config(BASIC_CONFIG))
+        self.assertEqual(os.listdir(self.dir.name), ["config.ini"])
+        self.assertEqual(self.state.config["TTS"]["prompt_text"], "参考文本")
+        self.assertEqual(self.state._mtime, self.state._file_mtime())
+
+    def test_invalid_config_is_not_written(self):
+        self.assertTrue(self.state.save_config(BASIC_CONFIG))
+        with open(self.state.config_file) as f:
+            before = f.read()
+        self.assertFalse(self.state.save_config({"Performance": {"llm_concurrency": "x"}}))
+        with open(self.state.config_file) as f:
+            self.assertEqual(f.read(), before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+"""共享HTTP客户端重建的测试
+
+运行：python -m pytest tests 或 python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aic_tts2 as app  # noqa: E402
+
+
+class ResetHttpClientsTest(unittest.TestCase):
+    def test_async_clients_are_closed_on_their_loop(self):
+        """重建客户端时，后台事件循环上的异步客户端在该循环上关闭"""
+        loop = app.get_background_loop()
+
+        async def get_client():
+            return app.get_async_http_client("tts")
+
+        client = asyncio.run_coroutine_threadsafe(get_client(), loop).result(5)
+        self.assertFalse(client.is_closed)
+        app.reset_http_clients()
+
+        async def closed():
+            # 关闭在事件循环上异步完成
+            for _ in range(100):
+                if client.is_closed:
+                    return True
+                await asyncio.sleep(0.01)
+            return False
+
+        self.assertTrue(asyncio.run_coroutine_threadsafe(closed(), loop).result(5))
+        new_client = asyncio.run_coroutine_threadsafe(get_client(), loop).result(5)
+        self.assertIsNot(new_client, client)
+
+
+if __name__ == "__main__":
+    unittest.main()
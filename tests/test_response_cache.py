@@ -0,0 +1,48 @@
+"""回复缓存文件读取的测试
+
+缓存文件能解析为JSON但格式不对时，应跳过坏条目或回退为空缓存，而不是在每轮对话时报错。
+
+运行：python -m pytest tests 或 python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aic_tts2 as app  # noqa: E402
+
+
+class ResponseCacheLoadTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def load(self, content):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return app.ResponseCache(self.path, ttl=3600, max_entries=10)
+
+    def test_wrong_top_level_shape(self):
+        cache = self.load('{"a": 1}')
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_invalid_json(self):
+        cache = self.load("not json")
+        self.assertEqual(len(cache.entries), 0)
+
+    def test_bad_entries_skipped(self):
+        now = time.time()
+        items = [[1, 2], ["k", "回复", now], "x", ["k2", 3, now], ["k3", "过期", now - 7200]]
+        cache = self.load(json.dumps(items))
+        self.assertEqual(list(cache.entries), ["k"])
+        self.assertEqual(cache.entries["k"][0], "回复")
+
+
+if __name__ == "__main__":
+    unittest.main()
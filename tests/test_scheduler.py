@@ -0,0 +1,134 @@
+"""请求调度器的测试：会话轮转、排队位置、队列上限和放弃排队
+
+运行：python -m pytest tests 或 python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aic_tts2 as app  # noqa: E402
+
+
+class StageSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = app.StageScheduler("测试", limit=1, max_queue=10)
+        # 占住唯一的名额，之后的请求都进入队列
+        self.running = self.scheduler.enqueue("占位")
+        self.assertTrue(self.running.granted.is_set())
+
+    def grant_order(self, tickets):
+        """依次释放正在执行的请求，返回各请求获得名额的顺序"""
+        order = []
+        current = self.running
+        for _ in tickets:
+            current.release()
+            current = next(ticket for ticket in tickets if ticket.granted.is_set() and ticket not in order)
+            order.append(current)
+        return order
+
+    def test_grants_immediately_when_idle(self):
+        scheduler = app.StageScheduler("测试", limit=2, max_queue=0)
+        first = scheduler.enqueue("甲")
+        second = scheduler.enqueue("甲")
+        self.assertTrue(first.wait(0) and second.wait(0))
+        self.assertEqual(scheduler.running, 2)
+        self.assertEqual(first.status_text(), "⏳ 排队中：第 0 位，已等待 0.0秒")
+
+    def test_round_robin_between_sessions(self):
+        """一个会话的多个请求与其他会话的请求轮流获得名额"""
+        a1, a2, a3 = (self.scheduler.enqueue("甲") for _ in range(3))
+        b1 = self.scheduler.enqueue("乙")
+        c1, c2 = (self.scheduler.enqueue("丙") for _ in range(2))
+        tickets = [a1, a2, a3, b1, c1, c2]
+        self.assertEqual(self.grant_order(tickets), [a1, b1, c1, a2, c2, a3])
+
+    def test_position_matches_grant_order(self):
+        a1, a2, a3 = (self.scheduler.enqueue("甲") for _ in range(3))
+        b1 = self.scheduler.enqueue("乙")
+        c1, c2 = (self.scheduler.enqueue("丙") for _ in range(2))
+        positions = {ticket: self.scheduler.position(ticket) for ticket in (a1, a2, a3, b1, c1, c2)}
+        self.assertEqual([positions[t] for t in (a1, b1, c1, a2, c2, a3)], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(self.scheduler.position(self.running), 0)
+        self.assertIn("第 4 位", a2.status_text("语音"))
+
+    def test_rejects_when_queue_is_full(self):
+        scheduler = app.StageScheduler("测试", limit=1, max_queue=2)
+        scheduler.enqueue("甲")
+        scheduler.enqueue("甲")
+        scheduler.enqueue("乙")
+        with self.assertRaises(app.SchedulerFull):
+            scheduler.enqueue("丙")
+        # 已被接纳的工作不受队列上限限制
+        admitted = scheduler.enqueue("甲", admitted=True)
+        self.assertEqual(scheduler.waiting, 3)
+        self.assertFalse(admitted.granted.is_set())
+
+    def test_release_while_queued_frees_the_place(self):
+        """排队时放弃：等待者返回 False，排在后面的请求前移，之后由下一个请求获得名额"""
+        abandoned = self.scheduler.enqueue("甲")
+        after = self.scheduler.enqueue("乙")
+        self.assertEqual(self.scheduler.position(after), 2)
+
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(abandoned.wait(2)))
+        waiter.start()
+        abandoned.release()
+        waiter.join()
+        self.assertEqual(results, [False])
+        self.assertEqual(self.scheduler.waiting, 1)
+        self.assertEqual(self.scheduler.position(after), 1)
+        abandoned.release()  # 重复调用无影响
+
+        self.running.release()
+        self.assertTrue(after.wait(0))
+        self.assertFalse(abandoned.granted.is_set())
+        after.release()
+        self.assertEqual((self.scheduler.running, self.scheduler.waiting), (0, 0))
+        self.assertEqual(len(self.scheduler.queues), 0)
+
+    def test_background_runs_after_user_requests(self):
+        """后台任务排在所有用户请求之后，不占用队列上限，放弃排队后不再获得名额"""
+        scheduler = app.StageScheduler("测试", limit=1, max_queue=1)
+        running = scheduler.enqueue("占位")
+        summary = scheduler.enqueue(None, background=True)
+        abandoned = scheduler.enqueue(None, background=True)
+        user = scheduler.enqueue("甲")
+        self.assertEqual(scheduler.waiting, 1)
+        self.assertEqual([scheduler.position(t) for t in (user, summary, abandoned)], [1, 2, 3])
+
+        abandoned.release()
+        self.assertFalse(abandoned.wait(0))
+        running.release()
+        self.assertTrue(user.granted.is_set())
+        self.assertFalse(summary.granted.is_set())
+        user.release()
+        self.assertTrue(summary.wait(0))
+        summary.release()
+        self.assertEqual(scheduler.running, 0)
+
+    def test_background_granted_when_idle(self):
+        scheduler = app.StageScheduler("测试", limit=1, max_queue=0)
+        self.assertTrue(scheduler.enqueue(None, background=True).wait(0))
+
+    def test_wait_async_is_woken_on_release(self):
+        queued = self.scheduler.enqueue("甲")
+
+        async def wait_for_slot():
+            self.assertFalse(await queued.wait_async(timeout=0.01))
+            asyncio.get_running_loop().call_later(0.01, self.running.release)
+            return await queued.wait_async(timeout=2)
+
+        self.assertTrue(asyncio.run(wait_for_slot()))
+        queued.release()
+
+    def test_resize_dispatches_waiting_requests(self):
+        queued = self.scheduler.enqueue("甲")
+        self.scheduler.resize(2, 10)
+        self.assertTrue(queued.wait(0))
+
+
+if __name__ == "__main__":
+    unittest.main()
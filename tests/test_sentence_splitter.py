@@ -0,0 +1,56 @@
+"""流式文本分句的测试
+
+运行：python -m pytest tests 或 python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aic_tts2 as app  # noqa: E402
+
+
+def split_all(chunks, min_chars=4):
+    splitter = app.SentenceSplitter(min_chars)
+    sentences = []
+    for chunk in chunks:
+        sentences.extend(splitter.feed(chunk))
+    return sentences + splitter.flush()
+
+
+class SentenceSplitterTest(unittest.TestCase):
+    def test_chinese_punctuation(self):
+        text = "今天天气很好。我们去公园吧！你觉得呢？"
+        self.assertEqual(split_all([text]), ["今天天气很好。", "我们去公园吧！", "你觉得呢？"])
+
+    def test_same_result_for_any_chunking(self):
+        text = "第一句话说完了。“第二句带引号！”第三句是 English. Done"
+        expected = split_all([text])
+        self.assertEqual(expected, ["第一句话说完了。", "“第二句带引号！”", "第三句是 English.", "Done"])
+        self.assertEqual(split_all(list(text)), expected)
+        for index in range(1, len(text)):
+            with self.subTest(index=index):
+                self.assertEqual(split_all([text[:index], text[index:]]), expected)
+
+    def test_waits_for_trailing_punctuation(self):
+        """标点在末尾时等待下一块，可能还有后续的标点或引号"""
+        splitter = app.SentenceSplitter()
+        self.assertEqual(splitter.feed("真的吗？"), [])
+        self.assertEqual(splitter.feed("！」然后"), ["真的吗？！」"])
+        self.assertEqual(splitter.flush(), ["然后"])
+
+    def test_decimal_point_does_not_split(self):
+        self.assertEqual(split_all(["价格是 3.14 元。好的"]), ["价格是 3.14 元。", "好的"])
+
+    def test_short_sentences_are_merged(self):
+        self.assertEqual(split_all(["嗯。好。这样就可以了。"]), ["嗯。好。", "这样就可以了。"])
+
+    def test_newline_ends_sentence(self):
+        self.assertEqual(split_all(["第一行内容\n第二行内容"]), ["第一行内容", "第二行内容"])
+
+    def test_flush_empty(self):
+        self.assertEqual(split_all(["   "]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
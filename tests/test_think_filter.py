@@ -0,0 +1,65 @@
+"""<think> 思考内容增量分离的测试
+
+运行：python -m pytest tests 或 python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aic_tts2 as app  # noqa: E402
+
+
+def feed_all(chunks):
+    """逐片段输入，返回拼接后的 (可见文本, 思考内容)"""
+    think_filter = app.ThinkFilter()
+    visible, thinking = [], []
+    for chunk in chunks:
+        new_visible, new_thinking = think_filter.feed(chunk)
+        visible.append(new_visible)
+        thinking.append(new_thinking)
+    new_visible, new_thinking = think_filter.flush()
+    visible.append(new_visible)
+    thinking.append(new_thinking)
+    return "".join(visible), "".join(thinking)
+
+
+class ThinkFilterTest(unittest.TestCase):
+    TEXT = "<think>先想一想</think>你好，世界"
+
+    def test_whole_text(self):
+        self.assertEqual(app.split_think(self.TEXT), ("你好，世界", "先想一想"))
+
+    def test_no_think(self):
+        self.assertEqual(app.split_think("你好 <b>世界</b>"), ("你好 <b>世界</b>", ""))
+
+    def test_every_split_point(self):
+        """标签在任意位置被拆到两个片段中，结果都与整段输入相同"""
+        for index in range(1, len(self.TEXT)):
+            with self.subTest(index=index):
+                chunks = [self.TEXT[:index], self.TEXT[index:]]
+                self.assertEqual(feed_all(chunks), ("你好，世界", "先想一想"))
+
+    def test_one_character_chunks(self):
+        self.assertEqual(feed_all(list(self.TEXT)), ("你好，世界", "先想一想"))
+
+    def test_partial_tag_is_held_back(self):
+        """片段末尾可能是标签开头的部分先不输出"""
+        think_filter = app.ThinkFilter()
+        self.assertEqual(think_filter.feed("答案<thi"), ("答案", ""))
+        self.assertEqual(think_filter.feed("s is"), ("<this is", ""))
+
+    def test_unclosed_think(self):
+        """输出在思考中结束时，暂存的部分算作思考内容"""
+        self.assertEqual(feed_all(["<think>还没想", "完</thi"]), ("", "还没想完</thi"))
+
+    def test_unfinished_open_tag_is_visible(self):
+        self.assertEqual(feed_all(["结尾是 <thin"]), ("结尾是 <thin", ""))
+
+    def test_multiple_blocks(self):
+        chunks = ["<think>一</think>甲", "<thi", "nk>二</th", "ink>乙"]
+        self.assertEqual(feed_all(chunks), ("甲乙", "一二"))
+
+
+if __name__ == "__main__":
+    unittest.main()
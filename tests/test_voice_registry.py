@@ -0,0 +1,146 @@
+"""声音登记在TTS服务重启后失效的测试
+
+模拟 GPT-SoVITS 的 api.py：/change_refer 设置默认参考音频，之后只带文本的请求使用它；
+没有默认参考音频时只带文本的请求返回 400。服务重启后默认参考音频丢失。
+
+运行：python -m pytest tests 或 python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aic_tts2 as app  # noqa: E402
+
+
+def make_wav():
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(b"\x00\x00" * 160)
+    return buffer.getvalue()
+
+
+class MockTTSHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests.append((url.path, params))
+        if self.server.reject_all:
+            self._send(400, b'{"code": 400, "message": "bad request"}', "application/json")
+        elif url.path == "/change_refer":
+            self.server.default_reference = params.get("refer_wav_path")
+            self._send(200, b'{"code": 0}', "application/json")
+        elif "refer_wav_path" in params or self.server.default_reference:
+            self._send(200, make_wav(), "audio/wav")
+        else:
+            self._send(400, '{"code": 400, "message": "未指定参考音频且接口无预设"}'.encode(), "application/json")
+
+
+def start_server(port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockTTSHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.default_reference = None
+    server.reject_all = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class VoiceRegistryRestartTest(unittest.TestCase):
+    def setUp(self):
+        self.server = start_server()
+        self.port = self.server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        handle, self.reference_wav = tempfile.mkstemp(suffix=".wav")
+        os.close(handle)
+        app.app_state._apply({
+            "API": {"tts_url": self.url},
+            "TTS": {"reference_wav": self.reference_wav, "prompt_text": "参考文本", "enable_tts": "True"},
+            "Performance": {"tts_cache": "False", "http_retries": "0"},
+        })
+        app._voice_registry = None
+        self.voice = app.app_state.config.get_voice()
+
+    def tearDown(self):
+        stop_server(self.server)
+        os.remove(self.reference_wav)
+        with app._endpoint_pools_lock:
+            for pool in app._endpoint_pools.values():
+                pool.stop()
+            app._endpoint_pools.clear()
+
+    def synthesize(self):
+        buffer = io.BytesIO()
+        app.download_tts_audio("你好。", buffer, voice=self.voice)
+        return buffer.getvalue()
+
+    def test_text_only_request_after_restart_falls_back_to_full_params(self):
+        """服务重启后只带文本的请求被拒绝，重试时带上参考音频，并在后台重新登记"""
+        registry = app.get_voice_registry()
+        self.assertEqual(registry.register(self.voice), [])
+        self.assertTrue(registry.is_registered(self.url, self.voice))
+
+        self.assertTrue(self.synthesize().startswith(b"RIFF"))
+        path, params = self.server.requests[-1]
+        self.assertNotIn("refer_wav_path", params)
+
+        # 在同一端口上重启服务，默认参考音频丢失
+        stop_server(self.server)
+        self.server = start_server(self.port)
+
+        self.assertTrue(self.synthesize().startswith(b"RIFF"))
+        synth_requests = [params for path, params in self.server.requests if path == "/"]
+        self.assertEqual(len(synth_requests), 2)
+        self.assertNotIn("refer_wav_path", synth_requests[0])
+        self.assertEqual(synth_requests[1]["refer_wav_path"], self.reference_wav)
+
+        # 后台重新登记后，请求又只带文本
+        self.assertTrue(wait_until(lambda: registry.is_registered(self.url, self.voice)))
+        self.assertEqual(self.server.default_reference, self.reference_wav)
+        self.assertTrue(self.synthesize().startswith(b"RIFF"))
+        self.assertNotIn("refer_wav_path", self.server.requests[-1][1])
+
+    def test_full_request_rejection_is_not_retried(self):
+        """带完整参数的请求被拒绝时直接失败，不重复请求"""
+        self.server.reject_all = True
+        with self.assertRaises(Exception):
+            self.synthesize()
+        self.assertEqual(len([path for path, _ in self.server.requests if path == "/"]), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()